@@ -5,10 +5,25 @@ import aiohttp
 import json
 import subprocess
 import random
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
 from pathlib import Path
+from urllib.parse import urljoin
+from collections import OrderedDict
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
 from yt_dlp import YoutubeDL, DownloadError
+from yt_dlp.cookies import YoutubeDLCookieJar
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
 
@@ -17,7 +32,14 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
+CHANNEL_LINK = os.getenv("CHANNEL_LINK", "https://t.me/smeshnoto4ka")
+# JSON со списком каналов и правилами маршрутизации (если файла нет - один канал CHANNEL_ID)
+CHANNELS_FILE = os.getenv("CHANNELS_FILE", "channels.json")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Свой сервер telegram-bot-api (например, http://localhost:8081): файлы до 2 ГБ и отправка по пути
+TELEGRAM_API_SERVER = os.getenv("TELEGRAM_API_SERVER")
+# Путь к папке бота внутри сервера, если сервер видит файлы по другому пути (например, в Docker)
+TELEGRAM_API_LOCAL_ROOT = os.getenv("TELEGRAM_API_LOCAL_ROOT")
 
 # ================== LLM INIT ==================
 llm_client = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
@@ -27,9 +49,147 @@ ADMIN_USERS = [
 ]
 
 # ================== INIT ==================
-bot = Bot(token=BOT_TOKEN)
+if TELEGRAM_API_SERVER:
+    bot_session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER, is_local=True))
+    bot = Bot(token=BOT_TOKEN, session=bot_session)
+    print(f"[DEBUG] Используется локальный Bot API сервер: {TELEGRAM_API_SERVER}")
+else:
+    bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+# ================== STORAGE ==================
+# Все состояние бота хранится в одной SQLite базе (WAL): опубликованные видео и ссылки,
+# счетчики и разрешенные пользователи. Старые текстовые файлы импортируются один раз.
+DB_FILE = os.getenv("DB_FILE", "bot.db")
+
+ALLOWED_USERS_FILE = "allowed_users.txt"
+POSTED_FILE = "posted.txt"
+POSTED_LINKS_FILE = "posted_links.txt"
+POST_COUNTER_FILE = "post_counter.txt"
+
+db = sqlite3.connect(DB_FILE, check_same_thread=False, timeout=30)
+db.execute("PRAGMA journal_mode=WAL")
+db.execute("PRAGMA synchronous=NORMAL")
+db.row_factory = sqlite3.Row
+# Одно соединение используется и из event loop, и из потоков пула загрузок
+db_lock = threading.Lock()
+
+def db_execute(query: str, params: tuple = ()) -> list:
+    """Выполняет запрос в отдельной транзакции и возвращает все строки результата"""
+    with db_lock, db:
+        return db.execute(query, params).fetchall()
+
+def init_db():
+    """Создает таблицы"""
+    with db_lock, db:
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS posted_videos (
+                video_id TEXT PRIMARY KEY,
+                posted_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS posted_links (
+                url TEXT PRIMARY KEY,
+                posted_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS allowed_users (
+                user_id INTEGER PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                state TEXT NOT NULL,
+                url TEXT NOT NULL,
+                source TEXT NOT NULL,
+                normalized_url TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                is_shorts INTEGER NOT NULL DEFAULT 0,
+                cookies_valid INTEGER NOT NULL DEFAULT 0,
+                video_id TEXT,
+                workdir TEXT,
+                video_path TEXT,
+                info TEXT,
+                caption TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state);
+            CREATE TABLE IF NOT EXISTS media_cache (
+                video_id TEXT PRIMARY KEY,
+                content_hash TEXT,
+                file_id TEXT NOT NULL,
+                thumbnail_file_id TEXT,
+                kind TEXT NOT NULL DEFAULT 'video',
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_media_cache_hash ON media_cache (content_hash);
+            CREATE TABLE IF NOT EXISTS channel_posts (
+                video_id TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                posted_at REAL NOT NULL,
+                PRIMARY KEY (video_id, chat_id)
+            );
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER,
+                total INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+        """)
+    
+    # Колонки, добавленные после создания таблиц (для баз со старой схемой)
+    ensure_column("jobs", "batch_id", "INTEGER")
+    ensure_column("jobs", "priority", "INTEGER NOT NULL DEFAULT 0")
+    ensure_column("jobs", "disk_bytes", "INTEGER")
+    ensure_column("jobs", "submitter_id", "INTEGER")
+    ensure_column("media_cache", "kind", "TEXT NOT NULL DEFAULT 'video'")
+
+def ensure_column(table: str, column: str, definition: str):
+    """Добавляет колонку в существующую таблицу, если ее еще нет"""
+    columns = {row[1] for row in db_execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        db_execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def read_file_lines(path: str) -> list:
+    """Читает непустые строки файла (если файла нет - пустой список)"""
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def migrate_text_files():
+    """Однократно переносит данные из старых текстовых файлов в базу"""
+    if db_execute("SELECT value FROM meta WHERE key = 'migrated_text_files'"):
+        return
+    
+    now = time.time()
+    video_ids = read_file_lines(POSTED_FILE)
+    links = read_file_lines(POSTED_LINKS_FILE)
+    user_ids = [int(line) for line in read_file_lines(ALLOWED_USERS_FILE) if line.isdigit()]
+    counter_lines = read_file_lines(POST_COUNTER_FILE)
+    post_count = int(counter_lines[0]) if counter_lines and counter_lines[0].isdigit() else 0
+    
+    with db_lock, db:
+        db.executemany("INSERT OR IGNORE INTO posted_videos (video_id, posted_at) VALUES (?, ?)", [(v, now) for v in video_ids])
+        db.executemany("INSERT OR IGNORE INTO posted_links (url, posted_at) VALUES (?, ?)", [(u, now) for u in links])
+        db.executemany("INSERT OR IGNORE INTO allowed_users (user_id) VALUES (?)", [(u,) for u in user_ids])
+        db.execute("INSERT OR REPLACE INTO counters (name, value) VALUES ('posts', ?)", (post_count,))
+        db.execute("INSERT INTO meta (key, value) VALUES ('migrated_text_files', ?)", (str(now),))
+    
+    print(f"[DEBUG] Миграция в SQLite: видео={len(video_ids)}, ссылок={len(links)}, пользователей={len(user_ids)}, постов={post_count}")
+
+init_db()
+migrate_text_files()
+
 # ================== ДОСТУП ==================
 # Пользователи, которые могут добавлять ссылки для скачивания видео
 ALLOWED_USER_IDS = [
@@ -38,32 +198,306 @@ ALLOWED_USER_IDS = [
 ]
 
 ALLOWED_USERS = set(ADMIN_USERS + ALLOWED_USER_IDS)
+ALLOWED_USERS.update(row[0] for row in db_execute("SELECT user_id FROM allowed_users"))
 
-ALLOWED_USERS_FILE = "allowed_users.txt"
-if not os.path.exists(ALLOWED_USERS_FILE):
-    open(ALLOWED_USERS_FILE, "w", encoding="utf-8").close()
+# ================== DEDUP INDEX ==================
+# Опубликованные ссылки и video_id загружаются в память один раз при старте,
+# дальше проверки дубликатов идут по множествам за O(1), а база хранит их надежно
+POSTED_VIDEO_IDS = set(row[0] for row in db_execute("SELECT video_id FROM posted_videos"))
+POSTED_LINKS = set(row[0] for row in db_execute("SELECT url FROM posted_links"))
 
-if os.path.exists(ALLOWED_USERS_FILE):
-    with open(ALLOWED_USERS_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip().isdigit():
-                ALLOWED_USERS.add(int(line.strip()))
+# ================== MEDIA CACHE ==================
+# file_id загруженных в Telegram видео: повторная отправка того же видео (в другой чат,
+# после ошибки, превью отправителю) идет ссылкой на file_id без повторной загрузки байтов
+MEDIA_HASH_CHUNK = 1024 * 1024
 
-POSTED_FILE = "posted.txt"
-if not os.path.exists(POSTED_FILE):
-    open(POSTED_FILE, "w", encoding="utf-8").close()
+def compute_content_hash(path: str) -> str:
+    """Быстрый хэш содержимого: размер, первый и последний мегабайт файла"""
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(MEDIA_HASH_CHUNK))
+        if size > MEDIA_HASH_CHUNK:
+            f.seek(max(MEDIA_HASH_CHUNK, size - MEDIA_HASH_CHUNK))
+            digest.update(f.read(MEDIA_HASH_CHUNK))
+    return digest.hexdigest()[:32]
 
-POSTED_LINKS_FILE = "posted_links.txt"
-if not os.path.exists(POSTED_LINKS_FILE):
-    open(POSTED_LINKS_FILE, "w", encoding="utf-8").close()
+def get_cached_media(video_id: str, content_hash: str = None):
+    """Ищет file_id по video_id, затем по хэшу содержимого (то же видео по другой ссылке)"""
+    rows = db_execute("SELECT * FROM media_cache WHERE video_id = ?", (video_id,))
+    if not rows and content_hash:
+        rows = db_execute("SELECT * FROM media_cache WHERE content_hash = ? LIMIT 1", (content_hash,))
+    return dict(rows[0]) if rows else None
 
-POST_COUNTER_FILE = "post_counter.txt"
-if not os.path.exists(POST_COUNTER_FILE):
-    with open(POST_COUNTER_FILE, "w", encoding="utf-8") as f:
-        f.write("0")
+# Telegram может вернуть MP4 без звука как animation, а неподходящий файл - как document
+SENT_MEDIA_KINDS = ("video", "animation", "document")
+
+def get_sent_media(sent_message) -> tuple:
+    """Возвращает (тип, объект) медиа из ответа Telegram или (None, None)"""
+    for kind in SENT_MEDIA_KINDS:
+        media = getattr(sent_message, kind, None)
+        if media is not None:
+            return kind, media
+    return None, None
+
+def save_cached_media(video_id: str, content_hash: str, sent_message):
+    """Сохраняет file_id видео и обложки из ответа Telegram"""
+    kind, media = get_sent_media(sent_message)
+    if media is None:
+        return
+    thumbnail = getattr(media, "thumbnail", None)
+    thumbnail_file_id = thumbnail.file_id if thumbnail else None
+    db_execute(
+        "INSERT OR REPLACE INTO media_cache (video_id, content_hash, file_id, thumbnail_file_id, kind, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (video_id, content_hash, media.file_id, thumbnail_file_id, kind, time.time()),
+    )
+
+# ================== JOB QUEUE ==================
+# Задачи хранятся в базе и переживают перезапуск: после деплоя каждая задача
+# продолжается с последнего завершенного этапа, а не скачивается заново
+JOB_PENDING = "pending"
+JOB_DOWNLOADING = "downloading"
+JOB_CAPTIONING = "captioning"
+JOB_PUBLISHING = "publishing"
+JOB_SCHEDULED = "scheduled"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+JOB_FINAL_STATES = (JOB_DONE, JOB_FAILED)
+
+# Поля задачи, которые хранятся в базе как JSON
+JOB_JSON_FIELDS = ("info", "caption")
+
+# Поля info от yt-dlp, которые нужны после загрузки (подпись, обложка, дубликаты)
+INFO_KEEP_FIELDS = (
+    "id", "title", "description", "duration", "uploader", "tags", "categories",
+    "thumbnail", "shortcode", "webpage_url", "width", "height", "ext",
+)
+
+# ================== PIPELINE QUEUES ==================
+# Обработка разбита на этапы со своими воркерами и ограниченными очередями между ними:
+# подпись следующего видео готовится, пока предыдущее загружается в канал
+DOWNLOAD_STAGE_WORKERS = int(os.getenv("DOWNLOAD_STAGE_WORKERS", os.getenv("DOWNLOAD_WORKERS", "4")))
+CAPTION_WORKERS = int(os.getenv("CAPTION_WORKERS", "3"))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", "4"))
+
+# Входная очередь загрузок не ограничена: задачи уже сохранены в базе
+download_queue = asyncio.Queue()
+caption_queue = asyncio.Queue(maxsize=STAGE_QUEUE_SIZE)
+thumbnail_queue = asyncio.Queue(maxsize=STAGE_QUEUE_SIZE)
+# Публикует один воркер, он же соблюдает паузы канала
+publish_queue = asyncio.Queue(maxsize=STAGE_QUEUE_SIZE)
+
+def compact_info(info: dict) -> dict:
+    """Оставляет из info только поля, нужные после загрузки"""
+    result = {key: info.get(key) for key in INFO_KEEP_FIELDS if info.get(key) is not None}
+    # Из списка превью нужны только маленькие - они подходят для обложки Telegram
+    thumbnails = [
+        {"url": t["url"], "width": t.get("width"), "height": t.get("height")}
+        for t in info.get("thumbnails") or []
+        if t.get("url") and t.get("width") and t["width"] <= 320
+    ]
+    if thumbnails:
+        result["thumbnails"] = thumbnails
+    return result
+
+def _row_to_job(row) -> dict:
+    job = dict(row)
+    for field in JOB_JSON_FIELDS:
+        if job.get(field):
+            job[field] = json.loads(job[field])
+    return job
+
+def create_job(url: str, source: str, normalized_url: str, chat_id: int, is_shorts: bool, cookies_valid: bool, batch_id: int = None, submitter_id: int = None) -> dict:
+    """Создает задачу в состоянии pending"""
+    now = time.time()
+    with db_lock, db:
+        cursor = db.execute(
+            "INSERT INTO jobs (state, url, source, normalized_url, chat_id, is_shorts, cookies_valid, batch_id, submitter_id, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (JOB_PENDING, url, source, normalized_url, chat_id, int(is_shorts), int(cookies_valid), batch_id, submitter_id, now, now)
+        )
+        job_id = cursor.lastrowid
+    return get_job(job_id)
+
+def get_job(job_id: int) -> dict:
+    """Возвращает задачу по id (или None)"""
+    rows = db_execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    return _row_to_job(rows[0]) if rows else None
+
+def update_job(job: dict, **fields):
+    """Обновляет поля задачи в базе и в переданном словаре"""
+    job.update(fields)
+    fields["updated_at"] = time.time()
+    values = [json.dumps(value, ensure_ascii=False, default=str) if key in JOB_JSON_FIELDS and value is not None else value for key, value in fields.items()]
+    assignments = ", ".join(f"{key} = ?" for key in fields)
+    db_execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*values, job["id"]))
+
+def get_unfinished_jobs() -> list:
+    """Возвращает незавершенные задачи в порядке создания"""
+    placeholders = ", ".join("?" for _ in JOB_FINAL_STATES)
+    rows = db_execute(f"SELECT * FROM jobs WHERE state NOT IN ({placeholders}) ORDER BY id", JOB_FINAL_STATES)
+    return [_row_to_job(row) for row in rows]
+
+async def notify_user(job: dict, text: str):
+    """Отправляет сообщение автору задачи (ошибки отправки не прерывают обработку)"""
+    # По задачам пакета пишется один общий прогресс вместо сообщений по каждой ссылке
+    if job.get("batch_id"):
+        return
+    try:
+        await bot.send_message(job["chat_id"], text)
+    except Exception as e:
+        print(f"[DEBUG] Notify error (job {job['id']}): {e}")
+
+# ================== JOB WORKSPACES ==================
+# Каждая задача получает свою папку, чтобы параллельные загрузки не перезаписывали файлы друг друга
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+
+def create_job_workspace() -> str:
+    """Создает уникальную рабочую папку для задачи"""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix="job_", dir=JOBS_DIR)
+
+def cleanup_job_workspace(workdir: str):
+    """Удаляет рабочую папку задачи вместе со всеми файлами"""
+    if workdir and os.path.isdir(workdir):
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def get_workspace_size(workdir: str) -> int:
+    """Сколько байт занимают файлы задачи на диске"""
+    if not workdir or not os.path.isdir(workdir):
+        return 0
+    total = 0
+    for root, _, files in os.walk(workdir):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def sweep_job_workspaces(keep: set = frozenset()):
+    """Удаляет папки задач, оставшиеся после падения или перезапуска (кроме keep)"""
+    if not os.path.isdir(JOBS_DIR):
+        return
+    
+    keep = {os.path.abspath(path) for path in keep if path}
+    removed = 0
+    for name in os.listdir(JOBS_DIR):
+        path = os.path.join(JOBS_DIR, name)
+        if os.path.abspath(path) in keep:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        removed += 1
+    
+    if removed:
+        print(f"[DEBUG] Удалено оставшихся рабочих папок: {removed}")
+
+# ================== ADMISSION CONTROL ==================
+# Каждая задача держит видео на диске до публикации, поэтому прием новых ссылок
+# ограничен числом незавершенных задач, а загрузки - объемом папок задач и свободным
+# местом. Переполненная очередь отказывает, нехватка места откладывает загрузку.
+ADMISSION_MAX_JOBS = int(os.getenv("ADMISSION_MAX_JOBS", "100"))
+ADMISSION_MAX_BYTES = int(float(os.getenv("ADMISSION_MAX_MB", "4096")) * 1024 * 1024)
+ADMISSION_MIN_FREE = int(float(os.getenv("ADMISSION_MIN_FREE_MB", "500")) * 1024 * 1024)
+# Сколько места резервируется под загрузку, пока размер видео неизвестен
+ADMISSION_JOB_ESTIMATE = int(float(os.getenv("ADMISSION_JOB_ESTIMATE_MB", "50")) * 1024 * 1024)
+# Сколько хендлер ждет освобождения очереди, прежде чем отказать
+ADMISSION_WAIT = float(os.getenv("ADMISSION_WAIT", "30"))
+ADMISSION_POLL_INTERVAL = 5
+
+ADMIT_OK = "ok"
+ADMIT_DEFER = "defer"
+ADMIT_FULL = "full"
+
+class AdmissionController:
+    """Лимиты на глубину очереди и байты на диске с ожиданием освобождения"""
+
+    def __init__(self):
+        # job_id -> зарезервированные байты для идущих загрузок
+        self.reserved = {}
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        """Место или слот в очереди освободились"""
+        self.changed.set()
+
+    def active_jobs(self) -> int:
+        placeholders = ", ".join("?" for _ in JOB_FINAL_STATES)
+        return db_execute(f"SELECT COUNT(*) FROM jobs WHERE state NOT IN ({placeholders})", JOB_FINAL_STATES)[0][0]
+
+    def staged_bytes(self) -> int:
+        """Байты файлов незавершенных задач (по базе, без обхода диска) плюс резерв под идущие загрузки"""
+        placeholders = ", ".join("?" for _ in JOB_FINAL_STATES)
+        stored = db_execute(f"SELECT COALESCE(SUM(disk_bytes), 0) FROM jobs WHERE state NOT IN ({placeholders})", JOB_FINAL_STATES)[0][0]
+        return stored + sum(self.reserved.values())
+
+    def disk_free(self) -> int:
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        return shutil.disk_usage(JOBS_DIR).free
+
+    def has_disk_space(self, extra: int = 0) -> bool:
+        return self.shortfall(extra) == 0
+
+    def shortfall(self, extra: int = 0) -> int:
+        """Сколько байт не хватает, чтобы занять еще extra"""
+        return max(
+            self.staged_bytes() + extra - ADMISSION_MAX_BYTES,
+            ADMISSION_MIN_FREE - (self.disk_free() - extra),
+            0,
+        )
+
+    def check(self, count: int = 1) -> str:
+        """Решение о приеме count новых задач"""
+        if self.active_jobs() + count > ADMISSION_MAX_JOBS:
+            return ADMIT_FULL
+        if not self.has_disk_space(ADMISSION_JOB_ESTIMATE):
+            return ADMIT_DEFER
+        return ADMIT_OK
+
+    def capacity(self) -> int:
+        """Сколько задач еще можно принять"""
+        return max(0, ADMISSION_MAX_JOBS - self.active_jobs())
+
+    async def wait_changed(self, timeout: float):
+        self.changed.clear()
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def admit(self, timeout: float = ADMISSION_WAIT) -> str:
+        """Ждет до timeout секунд, пока очередь не перестанет быть переполненной"""
+        deadline = time.monotonic() + timeout
+        decision = self.check()
+        while decision == ADMIT_FULL and time.monotonic() < deadline:
+            await self.wait_changed(min(ADMISSION_POLL_INTERVAL, deadline - time.monotonic()))
+            decision = self.check()
+        return decision
+
+    async def reserve(self, job: dict):
+        """Перед загрузкой: ждет свободного места и резервирует его под задачу"""
+        announced = False
+        while not self.has_disk_space(ADMISSION_JOB_ESTIMATE):
+            # Место занято файлами бэклога расписания - вытесняем дальние задачи вместо ожидания
+            if prefetcher.free_space(self.shortfall(ADMISSION_JOB_ESTIMATE)):
+                continue
+            if not announced:
+                print(f"[DEBUG] Загрузка задачи {job['id']} отложена: нет места ({self.staged_bytes() / 1024 / 1024:.0f} МБ занято)")
+                announced = True
+            await self.wait_changed(ADMISSION_POLL_INTERVAL)
+        self.reserved[job["id"]] = ADMISSION_JOB_ESTIMATE
 
-# ================== QUEUE ==================
-video_queue = asyncio.Queue()
+    def release(self, job: dict):
+        """После загрузки резерв заменяется фактическим размером папки задачи"""
+        if self.reserved.pop(job["id"], None) is not None:
+            self.notify()
+
+admission = AdmissionController()
 
 # ================== REGEX ==================
 YT_REGEX = r"(youtube\.com|youtu\.be)"
@@ -72,18 +506,6 @@ TT_REGEX = r"(tiktok\.com|vt\.tiktok\.com|vm\.tiktok\.com)"
 IG_REGEX = r"(?:www\.)?instagram\.com/(?:p|reel|reels|tv|stories)/"
 
 # ================== UTILS ==================
-async def expand_tiktok_url(url: str) -> str:
-    if "vm.tiktok.com" not in url and "vt.tiktok.com" not in url:
-        return url
-
-    try:
-        timeout = aiohttp.ClientTimeout(total=15)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, allow_redirects=True) as resp:
-                return str(resp.url)
-    except Exception:
-        return url
-
 def add_user_to_allowed(user_id: int) -> bool:
     """Добавляет пользователя в список разрешенных"""
     if user_id in ALLOWED_USERS:
@@ -91,9 +513,8 @@ def add_user_to_allowed(user_id: int) -> bool:
     
     ALLOWED_USERS.add(user_id)
     
-    # Сохраняем в файл
-    with open(ALLOWED_USERS_FILE, "a", encoding="utf-8") as f:
-        f.write(str(user_id) + "\n")
+    # Сохраняем в базу
+    db_execute("INSERT OR IGNORE INTO allowed_users (user_id) VALUES (?)", (user_id,))
     
     return True
 
@@ -104,11 +525,8 @@ def remove_user_from_allowed(user_id: int) -> bool:
     
     ALLOWED_USERS.discard(user_id)
     
-    # Перезаписываем файл без удаленного пользователя
-    with open(ALLOWED_USERS_FILE, "w", encoding="utf-8") as f:
-        for uid in ALLOWED_USERS:
-            if uid not in ADMIN_USERS:
-                f.write(str(uid) + "\n")
+    # Удаляем одну строку из базы вместо перезаписи всего списка
+    db_execute("DELETE FROM allowed_users WHERE user_id = ?", (user_id,))
     
     return True
 
@@ -160,41 +578,128 @@ def normalize_url(url: str, source: str) -> str:
     
     return url
 
-def is_link_posted(normalized_url: str) -> bool:
-    """Проверяет, была ли ссылка уже обработана"""
-    if not os.path.exists(POSTED_LINKS_FILE):
-        return False
+def detect_source(url: str):
+    """Определяет источник по ссылке (None - неподдерживаемая ссылка)"""
+    if re.search(YT_REGEX, url):
+        return "youtube"
+    if re.search(TT_REGEX, url):
+        return "tiktok"
+    if re.search(VK_REGEX, url):
+        return "vk"
+    if re.search(IG_REGEX, url):
+        return "instagram"
+    return None
+
+def is_playlist_url(url: str, source: str) -> bool:
+    """Ссылка на плейлист или канал (YouTube/VK), а не на одно видео"""
+    if source == "youtube":
+        return bool(re.search(r"youtube\.com/(?:playlist\?|channel/|c/|user/|@[^/?]+/?(?:videos|shorts|streams)?/?(?:$|\?))", url))
+    if source == "vk":
+        return bool(re.search(r"(?:/playlist/|section=(?:album|playlist)|/videos-?\d+/?$)", url))
+    return False
+
+def extract_video_id(url: str, source: str) -> str:
+    """
+    Возвращает video_id (как его отдает yt-dlp) прямо из ссылки, без сетевых запросов.
+    None - если по ссылке id не определить (тогда нужен запрос метаданных)
+    """
+    if source == "youtube":
+        normalized = normalize_url(url, source)
+        return normalized.split(":", 1)[1] if normalized.startswith("youtube:") else None
+    
+    if source == "tiktok":
+        match = re.search(r"tiktok\.com/@[^/]+/video/(\d+)", url)
+        return match.group(1) if match else None
     
-    with open(POSTED_LINKS_FILE, "r", encoding="utf-8") as f:
-        posted_links = set(line.strip() for line in f if line.strip())
+    if source == "instagram":
+        # Только shortcode поста/рилса; у сторис в нормализованной ссылке лишь имя автора
+        match = re.search(r"instagram\.com/(?:p|reel|reels|tv)/([^/?#]+)", url)
+        return match.group(1) if match else None
     
-    return normalized_url in posted_links
+    # У VK формат id в yt-dlp отличается от ссылки - определяем по метаданным
+    return None
+
+def is_link_posted(normalized_url: str) -> bool:
+    """Проверяет, была ли ссылка уже обработана"""
+    return normalized_url in POSTED_LINKS
 
 def add_link_to_posted(normalized_url: str):
     """Добавляет ссылку в список обработанных"""
-    with open(POSTED_LINKS_FILE, "a", encoding="utf-8") as f:
-        f.write(normalized_url + "\n")
+    if normalized_url in POSTED_LINKS:
+        return
+    
+    POSTED_LINKS.add(normalized_url)
+    db_execute("INSERT OR IGNORE INTO posted_links (url, posted_at) VALUES (?, ?)", (normalized_url, time.time()))
+
+def is_video_posted(video_id: str) -> bool:
+    """Проверяет, публиковалось ли видео с таким video_id"""
+    return video_id in POSTED_VIDEO_IDS
+
+def add_video_to_posted(video_id: str):
+    """Добавляет video_id в список опубликованных"""
+    if video_id in POSTED_VIDEO_IDS:
+        return
+    
+    POSTED_VIDEO_IDS.add(video_id)
+    db_execute("INSERT OR IGNORE INTO posted_videos (video_id, posted_at) VALUES (?, ?)", (video_id, time.time()))
 
 def get_post_count() -> int:
     """Возвращает текущий счетчик постов"""
-    try:
-        with open(POST_COUNTER_FILE, "r", encoding="utf-8") as f:
-            return int(f.read().strip() or "0")
-    except:
-        return 0
+    rows = db_execute("SELECT value FROM counters WHERE name = 'posts'")
+    return rows[0][0] if rows else 0
 
 def increment_post_count():
-    """Увеличивает счетчик постов"""
-    count = get_post_count() + 1
-    with open(POST_COUNTER_FILE, "w", encoding="utf-8") as f:
-        f.write(str(count))
-    return count
+    """Увеличивает счетчик постов (атомарно, в одной транзакции)"""
+    with db_lock, db:
+        db.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('posts', 0)")
+        db.execute("UPDATE counters SET value = value + 1 WHERE name = 'posts'")
+        return db.execute("SELECT value FROM counters WHERE name = 'posts'").fetchone()[0]
 
 def should_create_poll() -> bool:
     """Проверяет, нужно ли создавать опрос (каждый 5-й пост)"""
     return get_post_count() % 5 == 0
 
 # ================== LLM FUNCTIONS ==================
+LLM_MODEL = "gpt-4o-mini"
+
+CAPTION_SYSTEM_PROMPT = "Ты креативный контент-менеджер для юмористического Telegram-канала. ВАЖНО: Каждый раз создавай РАЗНЫЕ, УНИКАЛЬНЫЕ подписи! Не повторяйся! Используй разные стили, форматы, вопросы. Будь креативным и разнообразным."
+
+CAPTION_PROMPT_TEMPLATE = """
+Проанализируй это видео и создай УНИКАЛЬНЫЙ креативный контент для Telegram-канала "СМЕШНО.ТОЧКА".
+
+ВАЖНО: Каждый раз создавай РАЗНЫЕ подписи! Не повторяйся!
+
+Информация о видео:
+- Название: {title}
+- Описание: {description}
+- Длительность: {duration} сек
+- Источник: {source}
+- Автор: {uploader}
+- Теги: {tags_str}
+- Категории: {categories_str}
+
+Создай УНИКАЛЬНЫЙ контент:
+1. Креативный короткий заголовок (до 50 символов, БЕЗ эмодзи в начале, БЕЗ слова "СМЕШНО.ТОЧКА")
+2. {selected_style} к видео (1-2 предложения, НЕ используй слово "Жиза" каждый раз, будь креативным!)
+3. Один вовлекающий вопрос к аудитории (разные формулировки каждый раз)
+4. 3-5 релевантных хэштегов по теме видео (без #, через пробел)
+5. Вопрос для опроса
+6. 4 варианта ответа для опроса (короткие, до 20 символов каждый)
+
+Стили подписей для разнообразия:
+- "Когда ты...", "Это момент когда...", "Типичная ситуация...", "Поведение когда...", "Реакция на...", "Когда понимаешь что...", "Тот момент...", "Когда пытаешься...", "Ситуация когда...", "Когда видишь...", "Ощущение когда...", "Когда случайно...", "Когда думаешь что...", "Когда наконец...", "Когда осознаешь...", "Когда пытаешься объяснить...", "Когда все идет не так...", "Когда понимаешь что ты...", "Когда случайно делаешь...", "Когда пытаешься быть..."
+
+Ответь ТОЛЬКО в формате JSON:
+{{
+    "title": "уникальный заголовок",
+    "caption": "уникальная подпись в стиле {selected_style}",
+    "question": "уникальный вопрос",
+    "hashtags": "хэштег1 хэштег2 хэштег3",
+    "poll_question": "вопрос для опроса",
+    "poll_options": ["вариант1", "вариант2", "вариант3", "вариант4"]
+}}
+"""
+
 async def generate_caption_with_llm(video_info: dict, source: str) -> dict:
     """
     Генерирует креативную подпись через LLM
@@ -254,111 +759,8 @@ async def generate_caption_with_llm(video_info: dict, source: str) -> dict:
             "poll_options": ["1-3", "4-6", "7-8", "9-10"]
         }
     
-    # Формируем контекст для LLM
-    title = video_info.get("title", "Видео")
-    description = video_info.get("description", "")[:500]  # Ограничиваем длину
-    duration = video_info.get("duration", 0)
-    uploader = video_info.get("uploader", "")
-    tags = video_info.get("tags", [])
-    tags_str = ", ".join(tags[:10]) if isinstance(tags, list) else str(tags)[:200]
-    categories = video_info.get("categories", [])
-    categories_str = ", ".join(categories[:5]) if isinstance(categories, list) else ""
-    
-    # Генерируем случайный стиль для разнообразия
-    styles = [
-        "ироничный комментарий",
-        "смешное наблюдение",
-        "мемный формат",
-        "саркастичный комментарий",
-        "юмористическое замечание",
-        "остроумный комментарий"
-    ]
-    selected_style = random.choice(styles)
-    
-    context = f"""
-Проанализируй это видео и создай УНИКАЛЬНЫЙ креативный контент для Telegram-канала "СМЕШНО.ТОЧКА".
-
-ВАЖНО: Каждый раз создавай РАЗНЫЕ подписи! Не повторяйся!
-
-Информация о видео:
-- Название: {title}
-- Описание: {description[:400]}
-- Длительность: {duration} сек
-- Источник: {source}
-- Автор: {uploader}
-- Теги: {tags_str}
-- Категории: {categories_str}
-
-Создай УНИКАЛЬНЫЙ контент:
-1. Креативный короткий заголовок (до 50 символов, БЕЗ эмодзи в начале, БЕЗ слова "СМЕШНО.ТОЧКА")
-2. {selected_style} к видео (1-2 предложения, НЕ используй слово "Жиза" каждый раз, будь креативным!)
-3. Один вовлекающий вопрос к аудитории (разные формулировки каждый раз)
-4. 3-5 релевантных хэштегов по теме видео (без #, через пробел)
-5. Вопрос для опроса
-6. 4 варианта ответа для опроса (короткие, до 20 символов каждый)
-
-Стили подписей для разнообразия:
-- "Когда ты...", "Это момент когда...", "Типичная ситуация...", "Поведение когда...", "Реакция на...", "Когда понимаешь что...", "Тот момент...", "Когда пытаешься...", "Ситуация когда...", "Когда видишь...", "Ощущение когда...", "Когда случайно...", "Когда думаешь что...", "Когда наконец...", "Когда осознаешь...", "Когда пытаешься объяснить...", "Когда все идет не так...", "Когда понимаешь что ты...", "Когда случайно делаешь...", "Когда пытаешься быть..."
-
-Ответь ТОЛЬКО в формате JSON:
-{{
-    "title": "уникальный заголовок",
-    "caption": "уникальная подпись в стиле {selected_style}",
-    "question": "уникальный вопрос",
-    "hashtags": "хэштег1 хэштег2 хэштег3",
-    "poll_question": "вопрос для опроса",
-    "poll_options": ["вариант1", "вариант2", "вариант3", "вариант4"]
-}}
-"""
-    
     try:
-        print(f"[DEBUG] Генерирую подпись для видео: {title[:50]}...")
-        response = await llm_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Ты креативный контент-менеджер для юмористического Telegram-канала. ВАЖНО: Каждый раз создавай РАЗНЫЕ, УНИКАЛЬНЫЕ подписи! Не повторяйся! Используй разные стили, форматы, вопросы. Будь креативным и разнообразным."},
-                {"role": "user", "content": context}
-            ],
-            temperature=1.2,  # Увеличил для большей вариативности
-            max_tokens=600,
-            response_format={"type": "json_object"}
-        )
-        
-        result = json.loads(response.choices[0].message.content)
-        
-        # Добавляем эмодзи к заголовку (случайный выбор)
-        emoji_options = ["😂", "😅", "🤣", "😆", "💀", "😭", "🤪", "😎", "🔥", "✨"]
-        emoji = random.choice(emoji_options)
-        title_text = result.get('title', 'СМЕШНО.ТОЧКА').strip()
-        # Убираем "СМЕШНО.ТОЧКА" если оно есть в заголовке
-        if "СМЕШНО.ТОЧКА" in title_text.upper():
-            title_text = title_text.replace("СМЕШНО.ТОЧКА", "").replace("смешно.точка", "").strip()
-        result["title"] = f"{emoji} {title_text}" if title_text else f"{emoji} СМЕШНО.ТОЧКА"
-        
-        # Улучшаем подпись - добавляем эмодзи если его нет
-        caption_text = result.get("caption", "").strip()
-        if caption_text and not any(ord(c) > 127 for c in caption_text[:10]):  # Проверяем наличие эмодзи
-            caption_emojis = ["😂", "😅", "🤣", "💀", "🔥"]
-            result["caption"] = f"{caption_text} {random.choice(caption_emojis)}"
-        else:
-            result["caption"] = caption_text
-        
-        # Форматируем хэштеги
-        hashtags_str = result.get("hashtags", "")
-        if hashtags_str:
-            hashtag_list = [tag.strip() for tag in hashtags_str.split() if tag.strip()][:5]
-            result["hashtags"] = " ".join([f"#{tag}" for tag in hashtag_list])
-        else:
-            # Генерируем хэштеги на основе тегов видео
-            fallback_tags = ["жиза", "смешно", "мемы", "юмор"]
-            if tags_str:
-                # Пытаемся использовать теги из видео
-                video_tags = [tag.lower().strip() for tag in tags_str.split(",")[:3] if tag.strip()]
-                fallback_tags = video_tags + fallback_tags[:3-len(video_tags)]
-            result["hashtags"] = " ".join([f"#{tag}" for tag in fallback_tags[:5]])
-        
-        print(f"[DEBUG] Сгенерирована подпись: {result.get('caption', '')[:50]}...")
-        return result
+        return await get_cached_caption(video_info, source)
         
     except Exception as e:
         print(f"[DEBUG] LLM error: {e}")
@@ -394,53 +796,1781 @@ async def generate_caption_with_llm(video_info: dict, source: str) -> dict:
             "poll_options": ["1-3", "4-6", "7-8", "9-10"]
         }
 
-# ================== VIDEO PROCESSING ==================
-async def create_thumbnail(video_path: str) -> str:
-    """Создает обложку из первого кадра видео"""
-    thumbnail_path = "thumbnail.jpg"
-    try:
-        # Используем ffmpeg для извлечения первого кадра
-        cmd = [
-            "ffmpeg",
-            "-i", video_path,
-            "-ss", "00:00:00",
-            "-vframes", "1",
-            "-vf", "scale=1280:720:force_original_aspect_ratio=decrease",
-            thumbnail_path,
-            "-y"  # Перезаписать если существует
-        ]
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        await process.communicate()
+async def request_caption_from_llm(video_info: dict, source: str) -> dict:
+    """Один запрос подписи к LLM без кэша и fallback (ошибки пробрасываются)"""
+    # Формируем контекст для LLM
+    title = video_info.get("title", "Видео")
+    description = video_info.get("description", "")[:500]  # Ограничиваем длину
+    duration = video_info.get("duration", 0)
+    uploader = video_info.get("uploader", "")
+    tags = video_info.get("tags", [])
+    tags_str = ", ".join(tags[:10]) if isinstance(tags, list) else str(tags)[:200]
+    categories = video_info.get("categories", [])
+    categories_str = ", ".join(categories[:5]) if isinstance(categories, list) else ""
+    
+    # Генерируем случайный стиль для разнообразия
+    styles = [
+        "ироничный комментарий",
+        "смешное наблюдение",
+        "мемный формат",
+        "саркастичный комментарий",
+        "юмористическое замечание",
+        "остроумный комментарий"
+    ]
+    selected_style = random.choice(styles)
+    
+    context = CAPTION_PROMPT_TEMPLATE.format(
+        title=title,
+        description=description[:400],
+        duration=duration,
+        source=source,
+        uploader=uploader,
+        tags_str=tags_str,
+        categories_str=categories_str,
+        selected_style=selected_style,
+    )
+    
+    print(f"[DEBUG] Генерирую подпись для видео: {title[:50]}...")
+    response = await llm_client.chat.completions.create(
+        model=LLM_MODEL,
+        messages=[
+            {"role": "system", "content": CAPTION_SYSTEM_PROMPT},
+            {"role": "user", "content": context}
+        ],
+        temperature=1.2,  # Увеличил для большей вариативности
+        max_tokens=600,
+        response_format={"type": "json_object"},
+        timeout=LLM_TIMEOUT
+    )
+    
+    result = json.loads(response.choices[0].message.content)
+    
+    # Добавляем эмодзи к заголовку (случайный выбор)
+    emoji_options = ["😂", "😅", "🤣", "😆", "💀", "😭", "🤪", "😎", "🔥", "✨"]
+    emoji = random.choice(emoji_options)
+    title_text = result.get('title', 'СМЕШНО.ТОЧКА').strip()
+    # Убираем "СМЕШНО.ТОЧКА" если оно есть в заголовке
+    if "СМЕШНО.ТОЧКА" in title_text.upper():
+        title_text = title_text.replace("СМЕШНО.ТОЧКА", "").replace("смешно.точка", "").strip()
+    result["title"] = f"{emoji} {title_text}" if title_text else f"{emoji} СМЕШНО.ТОЧКА"
+    
+    # Улучшаем подпись - добавляем эмодзи если его нет
+    caption_text = result.get("caption", "").strip()
+    if caption_text and not any(ord(c) > 127 for c in caption_text[:10]):  # Проверяем наличие эмодзи
+        caption_emojis = ["😂", "😅", "🤣", "💀", "🔥"]
+        result["caption"] = f"{caption_text} {random.choice(caption_emojis)}"
+    else:
+        result["caption"] = caption_text
+    
+    # Форматируем хэштеги
+    hashtags_str = result.get("hashtags", "")
+    if hashtags_str:
+        hashtag_list = [tag.strip() for tag in hashtags_str.split() if tag.strip()][:5]
+        result["hashtags"] = " ".join([f"#{tag}" for tag in hashtag_list])
+    else:
+        # Генерируем хэштеги на основе тегов видео
+        fallback_tags = ["жиза", "смешно", "мемы", "юмор"]
+        if tags_str:
+            # Пытаемся использовать теги из видео
+            video_tags = [tag.lower().strip() for tag in tags_str.split(",")[:3] if tag.strip()]
+            fallback_tags = video_tags + fallback_tags[:3-len(video_tags)]
+        result["hashtags"] = " ".join([f"#{tag}" for tag in fallback_tags[:5]])
+    
+    print(f"[DEBUG] Сгенерирована подпись: {result.get('caption', '')[:50]}...")
+    return result
+
+# ================== CAPTION SERVICE ==================
+# Запросы подписей идут параллельно (с ограничением и таймаутом), одинаковые запросы
+# объединяются, а результаты кэшируются по video_id и хэшу шаблона промпта
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+CAPTION_CACHE_SIZE = int(os.getenv("CAPTION_CACHE_SIZE", "500"))
+CAPTION_CACHE_TTL = float(os.getenv("CAPTION_CACHE_TTL", str(24 * 3600)))
+
+# При изменении промпта или модели старые подписи в кэше перестают совпадать
+CAPTION_PROMPT_HASH = hashlib.sha1(
+    (LLM_MODEL + CAPTION_SYSTEM_PROMPT + CAPTION_PROMPT_TEMPLATE).encode("utf-8")
+).hexdigest()[:12]
+
+class TTLCache:
+    """LRU-кэш с ограниченным временем жизни записей"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
         
-        if os.path.exists(thumbnail_path):
-            return thumbnail_path
-    except Exception as e:
-        print(f"[DEBUG] Thumbnail creation error: {e}")
-    return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self.data[key]
+            return default
+        
+        self.data.move_to_end(key)
+        return value
 
-# ================== HANDLER ==================
-@dp.message()
-async def handler(msg: types.Message):
-    if msg.from_user.id not in ALLOWED_USERS:
-        return
+    def set(self, key, value):
+        self.data[key] = (value, time.monotonic() + self.ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
 
-    if not msg.text:
-        return
+caption_cache = TTLCache(CAPTION_CACHE_SIZE, CAPTION_CACHE_TTL)
+caption_inflight = {}
+caption_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
 
-    text = msg.text.strip()
+async def _request_caption_limited(video_info: dict, source: str) -> dict:
+    async with caption_semaphore:
+        return await asyncio.wait_for(request_caption_from_llm(video_info, source), LLM_TIMEOUT)
 
-    # ---------- /start ----------
+async def get_cached_caption(video_info: dict, source: str) -> dict:
+    """Возвращает подпись из кэша, из уже идущего запроса или делает новый запрос"""
+    video_id = video_info.get("id")
+    if not video_id:
+        return await _request_caption_limited(video_info, source)
+    
+    key = f"{source}:{video_id}:{CAPTION_PROMPT_HASH}"
+    cached = caption_cache.get(key)
+    if cached is not None:
+        print(f"[DEBUG] Подпись из кэша: {key}")
+        return dict(cached)
+    
+    task = caption_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_request_caption_limited(video_info, source))
+        caption_inflight[key] = task
+        
+        def on_done(done_task):
+            caption_inflight.pop(key, None)
+            if not done_task.cancelled() and done_task.exception() is None:
+                caption_cache.set(key, done_task.result())
+        
+        task.add_done_callback(on_done)
+    
+    # shield: отмена одного ожидающего не отменяет запрос для остальных
+    return dict(await asyncio.shield(task))
+
+# ================== HTTP CLIENT ==================
+# Одна сессия aiohttp на все время работы бота: пул соединений с keep-alive и
+# кэшем DNS вместо нового соединения и TLS-рукопожатия на каждую короткую ссылку
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "4"))
+SHORT_LINK_CACHE_SIZE = int(os.getenv("SHORT_LINK_CACHE_SIZE", "1000"))
+SHORT_LINK_CACHE_TTL = float(os.getenv("SHORT_LINK_CACHE_TTL", str(24 * 3600)))
+SHORT_LINK_MAX_HOPS = 5
+# Хосты коротких ссылок, которые раскрываются до канонического URL
+SHORT_LINK_HOSTS = ("vm.tiktok.com", "vt.tiktok.com", "youtu.be", "vk.cc")
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+}
+
+def get_short_link_host(url: str):
+    """Возвращает хост короткой ссылки или None, если ссылка не короткая"""
+    match = re.match(r"(?:https?://)?(?:www\.)?([^/?#\s]+)", url.strip())
+    if match and match.group(1).lower() in SHORT_LINK_HOSTS:
+        return match.group(1).lower()
+    return None
+
+class HttpClient:
+    """Общая сессия aiohttp и раскрытие коротких ссылок с кэшем"""
+
+    def __init__(self):
+        self.session = None
+        self.short_links = TTLCache(SHORT_LINK_CACHE_SIZE, SHORT_LINK_CACHE_TTL)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Создает сессию при первом обращении (внутри работающего event loop)"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                limit_per_host=HTTP_LIMIT_PER_HOST,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+                headers=HTTP_HEADERS,
+            )
+        return self.session
+
+    async def _next_hop(self, url: str):
+        """Один шаг редиректа: сначала HEAD, при отказе сервера - GET без чтения тела"""
+        session = self.get_session()
+        async with session.head(url, allow_redirects=False) as resp:
+            if resp.status not in (405, 501):
+                return resp.headers.get("Location") if 300 <= resp.status < 400 else None
+        
+        async with session.get(url, allow_redirects=False) as resp:
+            return resp.headers.get("Location") if 300 <= resp.status < 400 else None
+
+    async def resolve(self, url: str) -> str:
+        """Раскрывает короткую ссылку; редиректы идут, пока хост остается коротким"""
+        if get_short_link_host(url) is None:
+            return url
+        
+        url = url.strip()
+        if not url.startswith(("http://", "https://")):
+            url = "https://" + url
+        
+        cached = self.short_links.get(url)
+        if cached is not None:
+            print(f"[DEBUG] Короткая ссылка из кэша: {url} -> {cached}")
+            return cached
+        
+        current = url
+        try:
+            for _ in range(SHORT_LINK_MAX_HOPS):
+                location = await self._next_hop(current)
+                if not location:
+                    break
+                current = urljoin(current, location)
+                # Дальше канонического хоста не идем (страницы согласия, логина и т.п.)
+                if get_short_link_host(current) is None:
+                    break
+        except Exception as e:
+            print(f"[DEBUG] Не удалось раскрыть ссылку {url}: {e}")
+            return url
+        
+        if current != url:
+            self.short_links.set(url, current)
+            print(f"[DEBUG] Короткая ссылка раскрыта: {url} -> {current}")
+        return current
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+http_client = HttpClient()
+
+# ================== VIDEO PROCESSING ==================
+# Обложка собирается в памяти: сначала берется готовая картинка из метаданных yt-dlp,
+# иначе ffmpeg выбирает несколько кадров (seek по ключевым кадрам до декодирования),
+# оценивает их по яркости и контрасту и отдает лучший JPEG через stdout
+THUMBNAIL_CANDIDATES = (0.1, 0.3, 0.5)
+THUMBNAIL_MAX_SIDE = 320  # лимит Telegram на размер обложки
+THUMBNAIL_MAX_BYTES = 200 * 1024
+THUMBNAIL_MIN_BRIGHTNESS = 20
+THUMBNAIL_SAMPLE_SIDE = 32
+
+async def run_ffmpeg_pipe(cmd: list) -> bytes:
+    """Запускает ffmpeg/ffprobe и возвращает stdout (пустые байты при ошибке)"""
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, _ = await process.communicate()
+    return stdout if process.returncode == 0 else b""
+
+def jpeg_dimensions(data: bytes):
+    """Возвращает (ширина, высота) JPEG по маркеру SOF или None"""
+    if not data.startswith(b"\xff\xd8"):
+        return None
+    pos = 2
+    while pos + 9 < len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[pos + 5:pos + 7], "big")
+            width = int.from_bytes(data[pos + 7:pos + 9], "big")
+            return width, height
+        pos += 2 + length
+    return None
+
+async def fetch_info_thumbnail(info: dict):
+    """Скачивает подходящую для Telegram обложку из метаданных (без ffmpeg) или None"""
+    candidates = [t for t in info.get("thumbnails") or [] if t.get("url")]
+    candidates.sort(key=lambda t: t.get("width") or 0, reverse=True)
+    if info.get("thumbnail"):
+        candidates.append({"url": info["thumbnail"]})
+    
+    for thumbnail in candidates:
+        if (thumbnail.get("width") or 0) > THUMBNAIL_MAX_SIDE:
+            continue
+        try:
+            async with http_client.get_session().get(thumbnail["url"]) as resp:
+                if resp.status != 200:
+                    continue
+                data = await resp.content.read(THUMBNAIL_MAX_BYTES + 1)
+        except Exception as e:
+            print(f"[DEBUG] Не удалось скачать обложку: {e}")
+            continue
+        
+        size = jpeg_dimensions(data)
+        if len(data) <= THUMBNAIL_MAX_BYTES and size and max(size) <= THUMBNAIL_MAX_SIDE:
+            return data
+    return None
+
+async def score_frame(video_path: str, position: float) -> float:
+    """Оценка кадра: дисперсия яркости уменьшенного серого кадра (темные кадры - 0)"""
+    cmd = [
+        "ffmpeg", "-v", "error",
+        "-ss", f"{position:.2f}",  # seek до -i: переход по ключевым кадрам без декодирования с начала
+        "-i", video_path,
+        "-frames:v", "1",
+        "-vf", f"scale={THUMBNAIL_SAMPLE_SIDE}:{THUMBNAIL_SAMPLE_SIDE}",
+        "-pix_fmt", "gray",
+        "-f", "rawvideo", "-",
+    ]
+    pixels = await run_ffmpeg_pipe(cmd)
+    if not pixels:
+        return -1.0
+    
+    mean = sum(pixels) / len(pixels)
+    if mean < THUMBNAIL_MIN_BRIGHTNESS:
+        return 0.0
+    return sum((p - mean) ** 2 for p in pixels) / len(pixels)
+
+async def extract_frame_jpeg(video_path: str, position: float) -> bytes:
+    """Извлекает один кадр в JPEG через stdout, без временного файла"""
+    cmd = [
+        "ffmpeg", "-v", "error",
+        "-ss", f"{position:.2f}",
+        "-i", video_path,
+        "-frames:v", "1",
+        "-vf", f"scale={THUMBNAIL_MAX_SIDE}:{THUMBNAIL_MAX_SIDE}:force_original_aspect_ratio=decrease",
+        "-q:v", "4",
+        "-f", "image2pipe", "-vcodec", "mjpeg", "-",
+    ]
+    return await run_ffmpeg_pipe(cmd)
+
+async def create_thumbnail(video_path: str, info: dict = None):
+    """Создает обложку в памяти. Возвращает JPEG-байты или None"""
+    info = info or {}
+    try:
+        data = await fetch_info_thumbnail(info)
+        if data:
+            print(f"[DEBUG] Обложка из метаданных ({len(data)} байт)")
+            return data
+        
+        duration = info.get("duration") or (await probe_media(video_path))["duration"] or 0
+        positions = [duration * fraction for fraction in THUMBNAIL_CANDIDATES] if duration >= 1 else [0.0]
+        scores = await asyncio.gather(*(score_frame(video_path, position) for position in positions))
+        best_position = max(zip(scores, positions))[1]
+        
+        data = await extract_frame_jpeg(video_path, best_position)
+        if data:
+            print(f"[DEBUG] Обложка из кадра {best_position:.1f} с ({len(data)} байт)")
+            return data
+    except Exception as e:
+        print(f"[DEBUG] Thumbnail creation error: {e}")
+    return None
+
+# ================== TRANSCODE POOL ==================
+# Все тяжелые вызовы ffmpeg идут через общий пул: не больше TRANSCODE_WORKERS процессов
+# одновременно, задачи берутся из очереди по приоритету (меньше - раньше)
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(os.cpu_count() or 1)))
+# Потоки x264 на один процесс, чтобы параллельные кодирования не мешали друг другу
+TRANSCODE_THREADS = max(1, (os.cpu_count() or 1) // TRANSCODE_WORKERS)
+
+class TranscodePool:
+    """Пул процессов ffmpeg с приоритетной очередью"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queue = asyncio.PriorityQueue()
+        # Порядковый номер сохраняет FIFO внутри одного приоритета
+        self.seq = 0
+
+    async def run(self, cmd: list, priority: float = 0) -> bytes:
+        """Ставит команду в очередь и ждет ее завершения. Возвращает stdout"""
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        self.queue.put_nowait((priority, self.seq, cmd, future))
+        return await future
+
+    async def worker(self):
+        while True:
+            priority, _, cmd, future = await self.queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                stdout, stderr = await process.communicate()
+                if future.cancelled():
+                    continue
+                if process.returncode != 0:
+                    future.set_exception(RuntimeError(f"ffmpeg: {stderr.decode(errors='ignore')[-300:]}"))
+                else:
+                    future.set_result(stdout)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def start(self) -> list:
+        return [self.worker() for _ in range(self.workers)]
+
+transcode_pool = TranscodePool(TRANSCODE_WORKERS)
+
+# ================== MEDIA NORMALIZATION ==================
+# Скачанный файл проверяется через ffprobe: если кодеки уже подходят Telegram,
+# файл только перепаковывается (stream copy), перекодирование - только при необходимости
+NORMALIZE_SOURCES = {s.strip() for s in os.getenv("NORMALIZE_SOURCES", "instagram").split(",") if s.strip()}
+TELEGRAM_VIDEO_CODECS = ("h264",)
+TELEGRAM_PIX_FMTS = ("yuv420p", "yuvj420p")
+TELEGRAM_AUDIO_CODECS = ("aac", "mp3")
+TRANSCODE_VIDEO_ARGS = ["-c:v", "libx264", "-preset", "fast", "-crf", "23", "-pix_fmt", "yuv420p", "-threads", str(TRANSCODE_THREADS)]
+TRANSCODE_AUDIO_ARGS = ["-c:a", "aac", "-b:a", "128k"]
+
+async def probe_media(video_path: str) -> dict:
+    """Возвращает кодеки файла через ffprobe: {"format", "duration", "video", "pix_fmt", "audio"}"""
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=format_name,duration:stream=codec_type,codec_name,pix_fmt",
+        "-of", "json",
+        video_path,
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffprobe: {stderr.decode(errors='ignore')[:300]}")
+    
+    data = json.loads(stdout or b"{}")
+    fmt = data.get("format", {})
+    result = {
+        "format": fmt.get("format_name", ""),
+        "duration": float(fmt["duration"]) if fmt.get("duration") else None,
+        "video": None,
+        "pix_fmt": None,
+        "audio": None,
+    }
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") == "video" and result["video"] is None:
+            result["video"] = stream.get("codec_name")
+            result["pix_fmt"] = stream.get("pix_fmt")
+        elif stream.get("codec_type") == "audio" and result["audio"] is None:
+            result["audio"] = stream.get("codec_name")
+    return result
+
+def is_faststart(video_path: str) -> bool:
+    """Проверяет, что атом moov в MP4 идет до mdat (видео можно смотреть до полной загрузки)"""
+    try:
+        with open(video_path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size = int.from_bytes(header[:4], "big")
+                box_type = header[4:8]
+                if box_type == b"moov":
+                    return True
+                if box_type == b"mdat":
+                    return False
+                if size == 1:
+                    size = int.from_bytes(f.read(8), "big")
+                    if size < 16:
+                        return False
+                    f.seek(size - 16, os.SEEK_CUR)
+                elif size < 8:
+                    # 0 - атом до конца файла, меньше 8 - это не MP4
+                    return False
+                else:
+                    f.seek(size - 8, os.SEEK_CUR)
+    except OSError:
+        return False
+
+def build_normalize_args(media: dict) -> tuple:
+    """Аргументы кодеков ffmpeg для H.264/AAC MP4. Возвращает (args, нужно_ли_перекодирование)"""
+    video_ok = media["video"] in TELEGRAM_VIDEO_CODECS and media["pix_fmt"] in TELEGRAM_PIX_FMTS
+    audio_ok = media["audio"] is None or media["audio"] in TELEGRAM_AUDIO_CODECS
+    
+    # Каждый поток копируется, если подходит, и перекодируется, только если нет
+    args = ["-c:v", "copy"] if video_ok else list(TRANSCODE_VIDEO_ARGS)
+    if media["audio"] is not None:
+        args += ["-c:a", "copy"] if audio_ok else list(TRANSCODE_AUDIO_ARGS)
+    return args, not (video_ok and audio_ok)
+
+async def normalize_media(video_path: str) -> str:
+    """
+    Приводит файл к формату, который Telegram воспроизводит без обработки.
+    Возвращает выполненное действие: "skip", "stream", "remux" или "transcode"
+    """
+    media = await probe_media(video_path)
+    codec_args, needs_transcode = build_normalize_args(media)
+    
+    if not needs_transcode and "mp4" in media["format"] and is_faststart(video_path):
+        print(f"[DEBUG] Нормализация не нужна: {media}")
+        return "skip"
+    
+    if not needs_transcode and STREAM_UPLOAD:
+        # Перепаковка пройдет на лету во время отправки, без лишней копии файла на диске
+        print(f"[DEBUG] Перепаковка отложена до отправки: {media}")
+        return "stream"
+    
+    action = "transcode" if needs_transcode else "remux"
+    tmp_path = video_path + ".normalized.mp4"
+    cmd = [
+        "ffmpeg", "-y", "-v", "error",
+        "-i", video_path,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        *codec_args,
+        "-movflags", "+faststart",
+        tmp_path,
+    ]
+    try:
+        # Перепаковка быстрая - она идет вне очереди перед перекодированиями
+        await transcode_pool.run(cmd, priority=1 if needs_transcode else 0)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    os.replace(tmp_path, video_path)
+    print(f"[DEBUG] Нормализация ({action}): {media}")
+    return action
+
+# ================== STREAMING UPLOAD ==================
+# Файл без faststart не переписывается на диск целиком: ffmpeg перепаковывает его
+# в fragmented MP4 прямо в тело запроса к Telegram (stream copy, без перекодирования)
+STREAM_UPLOAD = os.getenv("STREAM_UPLOAD", "1").lower() in ("1", "true", "yes")
+STREAM_CHUNK_SIZE = 256 * 1024
+STREAM_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+class FfmpegStreamInputFile(types.InputFile):
+    """InputFile, который отдает вывод ffmpeg (fragmented MP4) по частям, пока он создается"""
+
+    def __init__(self, path: str, filename: str = None, chunk_size: int = STREAM_CHUNK_SIZE):
+        super().__init__(filename=filename or os.path.basename(path), chunk_size=chunk_size)
+        self.path = path
+
+    async def read(self, bot):
+        # Каждый вызов (в том числе повтор после flood wait) запускает свой ffmpeg
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-v", "error",
+            "-i", self.path,
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-c", "copy",
+            "-movflags", STREAM_MOVFLAGS,
+            "-f", "mp4", "pipe:1",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            while chunk := await process.stdout.read(self.chunk_size):
+                yield chunk
+            
+            stderr = await process.stderr.read()
+            if await process.wait() != 0:
+                # Обрываем загрузку, чтобы Telegram не получил обрезанное видео
+                raise RuntimeError(f"ffmpeg: {stderr.decode(errors='ignore')[-300:]}")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+def get_stream_video_meta(info: dict) -> dict:
+    """
+    Длительность и размеры для send_video: в fragmented MP4 (empty_moov) их нет в заголовке,
+    и без них Telegram может показать 0:00 и неверные пропорции. Поток не перекодируется,
+    поэтому значения из метаданных yt-dlp совпадают с файлом
+    """
+    meta = {}
+    for key in ("duration", "width", "height"):
+        if info.get(key):
+            meta[key] = int(info[key])
+    return meta
+
+def local_file_uri(path: str) -> str:
+    """file:// ссылка на файл, как ее видит локальный Bot API сервер"""
+    path = os.path.abspath(path)
+    if TELEGRAM_API_LOCAL_ROOT:
+        path = os.path.join(TELEGRAM_API_LOCAL_ROOT, os.path.relpath(path, os.getcwd()))
+    return Path(path).as_uri()
+
+def open_video_input(video_path: str):
+    """
+    Файл с faststart отправляется как есть (с локальным сервером - просто путем file://),
+    остальные - через перепаковку на лету
+    """
+    faststart = is_faststart(video_path)
+    if TELEGRAM_API_SERVER and (faststart or not STREAM_UPLOAD):
+        # Сервер читает файл с диска сам, байты через HTTP не передаются
+        return local_file_uri(video_path)
+    if STREAM_UPLOAD and not faststart:
+        print(f"[DEBUG] Потоковая отправка с перепаковкой: {video_path}")
+        return FfmpegStreamInputFile(video_path, filename="video.mp4")
+    return types.FSInputFile(video_path)
+
+# ================== SIZE LIMIT ==================
+# Файлы больше лимита Bot API пережимаются в двухпроходном режиме под бюджет в байтах,
+# рассчитанный из длительности, вместо ошибки при отправке
+# Публичный Bot API принимает от ботов до 50 МБ, локальный сервер - до 2000 МБ
+TELEGRAM_UPLOAD_LIMIT = int(float(os.getenv("TELEGRAM_UPLOAD_LIMIT_MB", "2000" if TELEGRAM_API_SERVER else "50")) * 1024 * 1024)
+# Запас на контейнер MP4 и неточность битрейта x264
+TRANSCODE_SIZE_MARGIN = 0.92
+TRANSCODE_MIN_VIDEO_KBPS = 150
+TRANSCODE_MAX_ATTEMPTS = 2
+
+def pick_target_height(video_kbps: float) -> int:
+    """Чем меньше битрейт, тем меньше разрешение - иначе картинка развалится на блоки"""
+    if video_kbps >= 2500:
+        return 1080
+    if video_kbps >= 1200:
+        return 720
+    if video_kbps >= 600:
+        return 480
+    return 360
+
+async def shrink_to_limit(video_path: str, duration: float, limit: int = TELEGRAM_UPLOAD_LIMIT) -> int:
+    """Двухпроходное кодирование в бюджет limit байт. Возвращает новый размер файла"""
+    if not duration:
+        duration = (await probe_media(video_path))["duration"]
+    if not duration:
+        raise RuntimeError("неизвестна длительность видео")
+    
+    workdir = os.path.dirname(video_path)
+    tmp_path = video_path + ".shrunk.mp4"
+    passlog = os.path.join(workdir, "x264_pass")
+    margin = TRANSCODE_SIZE_MARGIN
+    
+    for attempt in range(TRANSCODE_MAX_ATTEMPTS):
+        total_kbps = limit * 8 * margin / duration / 1000
+        audio_kbps = 96 if total_kbps > 800 else 64
+        video_kbps = int(total_kbps - audio_kbps)
+        if video_kbps < TRANSCODE_MIN_VIDEO_KBPS:
+            raise RuntimeError(f"видео слишком длинное для лимита ({duration:.0f} с)")
+        
+        height = pick_target_height(video_kbps)
+        video_args = [
+            "-map", "0:v:0",
+            "-vf", f"scale=-2:'min({height},ih)'",
+            "-c:v", "libx264", "-preset", "medium", "-pix_fmt", "yuv420p",
+            "-b:v", f"{video_kbps}k",
+            "-threads", str(TRANSCODE_THREADS),
+            "-passlogfile", passlog,
+        ]
+        first_pass = ["ffmpeg", "-y", "-v", "error", "-i", video_path, *video_args, "-pass", "1", "-an", "-f", "mp4", os.devnull]
+        second_pass = [
+            "ffmpeg", "-y", "-v", "error", "-i", video_path, *video_args, "-pass", "2",
+            "-maxrate", f"{int(video_kbps * 1.5)}k", "-bufsize", f"{video_kbps * 2}k",
+            "-map", "0:a:0?", "-c:a", "aac", "-b:a", f"{audio_kbps}k",
+            "-movflags", "+faststart",
+            tmp_path,
+        ]
+        
+        print(f"[DEBUG] Сжатие под лимит: {video_kbps}k видео, {audio_kbps}k аудио, до {height}p (попытка {attempt + 1})")
+        # Короткие видео сжимаются быстрее - они идут в очереди первыми
+        try:
+            await transcode_pool.run(first_pass, priority=2 + duration)
+            await transcode_pool.run(second_pass, priority=2 + duration)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        
+        size = os.path.getsize(tmp_path)
+        if size <= limit:
+            os.replace(tmp_path, video_path)
+            return size
+        
+        # Промахнулись по размеру - уменьшаем бюджет пропорционально и пробуем еще раз
+        margin *= limit / size * 0.95
+    
+    os.remove(tmp_path)
+    raise RuntimeError("не удалось уложиться в лимит размера")
+
+# ================== COOKIES ==================
+# Файлы cookies разбираются один раз и перечитываются только при изменении mtime.
+# yt-dlp получает общий jar из памяти вместо повторного разбора файла на каждую попытку.
+YOUTUBE_COOKIE_FILES = [path.strip() for path in os.getenv("YOUTUBE_COOKIE_FILES", "youtube_cookies.txt").split(",") if path.strip()]
+# Без этих cookies авторизация на YouTube не работает
+YOUTUBE_REQUIRED_COOKIES = [name.strip() for name in os.getenv("YOUTUBE_REQUIRED_COOKIES", "SID,HSID,SSID,APISID,SAPISID").split(",") if name.strip()]
+YOUTUBE_COOKIE_DOMAINS = ("youtube.com", "google.com")
+
+class CookieJarManager:
+    """Кэш разобранных Netscape cookie-файлов с горячей перезагрузкой и ротацией"""
+
+    def __init__(self, paths: list, required: list, domains: tuple):
+        self.paths = paths
+        self.required = required
+        self.domains = domains
+        # path -> {"mtime": float, "jar": YoutubeDLCookieJar, "valid": bool}
+        self.entries = {}
+        self.rotation = 0
+        # Обращения идут из потоков пула загрузок
+        self.lock = threading.Lock()
+
+    def _load(self, path: str, mtime: float) -> dict:
+        """Разбирает файл и оставляет только cookies нужных доменов"""
+        source_jar = YoutubeDLCookieJar(path)
+        source_jar.load(ignore_discard=True, ignore_expires=True)
+        
+        jar = YoutubeDLCookieJar()
+        for cookie in source_jar:
+            if cookie.domain.lstrip(".").endswith(self.domains):
+                jar.set_cookie(cookie)
+        
+        valid = self._is_valid(jar)
+        print(f"[DEBUG] Cookies {path}: {len(jar)} шт., {'валидны' if valid else 'невалидны'}")
+        return {"mtime": mtime, "jar": jar, "valid": valid}
+
+    def _is_valid(self, jar: YoutubeDLCookieJar) -> bool:
+        """Валидность по сроку действия и наличию обязательных cookies"""
+        now = time.time()
+        alive = {cookie.name for cookie in jar if not cookie.is_expired(now)}
+        return bool(alive) and all(name in alive for name in self.required)
+
+    def refresh(self):
+        """Перечитывает файлы, у которых изменился mtime (и перепроверяет сроки действия)"""
+        with self.lock:
+            for path in self.paths:
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    self.entries.pop(path, None)
+                    continue
+                
+                entry = self.entries.get(path)
+                if entry is None or entry["mtime"] != mtime:
+                    try:
+                        self.entries[path] = self._load(path, mtime)
+                    except Exception as e:
+                        print(f"[DEBUG] Ошибка чтения cookies {path}: {e}")
+                        self.entries.pop(path, None)
+                else:
+                    entry["valid"] = self._is_valid(entry["jar"])
+
+    def has_valid(self) -> bool:
+        self.refresh()
+        return any(entry["valid"] for entry in self.entries.values())
+
+    def get_jar(self):
+        """Возвращает jar для запроса: валидные файлы по кругу, иначе любой загруженный"""
+        self.refresh()
+        with self.lock:
+            entries = [entry for entry in self.entries.values() if entry["valid"]] or list(self.entries.values())
+            if not entries:
+                return None
+            self.rotation += 1
+            return entries[self.rotation % len(entries)]["jar"]
+
+youtube_cookies = CookieJarManager(YOUTUBE_COOKIE_FILES, YOUTUBE_REQUIRED_COOKIES, YOUTUBE_COOKIE_DOMAINS)
+
+def open_youtube_dl(ydl_opts: dict) -> YoutubeDL:
+    """Создает YoutubeDL; при use_shared_cookies подставляет общий jar из памяти"""
+    opts = dict(ydl_opts)
+    use_shared_cookies = opts.pop("use_shared_cookies", False)
+    ydl = YoutubeDL(opts)
+    if use_shared_cookies:
+        jar = youtube_cookies.get_jar()
+        if jar is not None:
+            ydl.cookiejar = jar
+    return ydl
+
+# ================== YOUTUBE CLIENT STRATEGY ==================
+# Успехи и ошибки каждой конфигурации клиента YouTube учитываются с затуханием во времени:
+# конфигурация, которая сейчас работает, пробуется первой, а постоянно падающие
+# временно пропускаются. Когда YouTube что-то меняет, порядок перестраивается сам.
+STRATEGY_HALF_LIFE = float(os.getenv("STRATEGY_HALF_LIFE", "3600"))
+STRATEGY_MAX_FAILURES = int(os.getenv("STRATEGY_MAX_FAILURES", "3"))
+STRATEGY_COOLDOWN = float(os.getenv("STRATEGY_COOLDOWN", "900"))
+
+# Ошибки самого видео (приватное, удалено) не говорят ничего о клиенте
+VIDEO_ERROR_CLASSES = ("unavailable",)
+
+def classify_download_error(err_str: str) -> str:
+    """Определяет класс ошибки загрузки для статистики стратегий"""
+    if any(s in err_str for s in ("No video formats found", "Private video", "private video", "Video unavailable", "This video is not available")):
+        return "unavailable"
+    if "403" in err_str or "Forbidden" in err_str:
+        return "forbidden"
+    if "Sign in" in err_str:
+        return "sign_in"
+    if any(s in err_str for s in ("Failed to extract", "player response", "Unable to extract")):
+        return "extract"
+    return "other"
+
+def client_config_key(config: dict) -> str:
+    """Ключ конфигурации клиента для статистики"""
+    client = "+".join(config["client"]) if config.get("client") else "default"
+    return f"{client}|age_gate={int(config.get('age_gate', False))}|cookies={int(config.get('use_cookies', False))}"
+
+class ClientStrategySelector:
+    """Статистика конфигураций клиентов по источникам с экспоненциальным затуханием"""
+
+    def __init__(self, half_life: float, max_failures: int, cooldown: float):
+        self.half_life = half_life
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        # (источник, ключ конфигурации) -> статистика
+        self.stats = {}
+
+    def _get(self, source: str, config: dict) -> dict:
+        key = (source, client_config_key(config))
+        stat = self.stats.setdefault(key, {
+            "success": 0.0,
+            "failure": 0.0,
+            "errors": {},
+            "streak": 0,
+            "skip_until": 0.0,
+            "updated": time.monotonic(),
+        })
+        
+        # Затухание: старые успехи и ошибки весят все меньше
+        now = time.monotonic()
+        factor = 0.5 ** ((now - stat["updated"]) / self.half_life)
+        stat["success"] *= factor
+        stat["failure"] *= factor
+        stat["errors"] = {error_class: count * factor for error_class, count in stat["errors"].items()}
+        stat["updated"] = now
+        return stat
+
+    def score(self, source: str, config: dict) -> float:
+        """Оценка вероятности успеха (сглаживание Лапласа: новые конфигурации получают 0.5)"""
+        stat = self._get(source, config)
+        return (stat["success"] + 1) / (stat["success"] + stat["failure"] + 2)
+
+    def order(self, source: str, configs: list) -> list:
+        """Сортирует конфигурации по оценке, временно отключенные убирает в конец"""
+        now = time.monotonic()
+        # sorted устойчив: при равных оценках сохраняется исходный порядок приоритета
+        ranked = sorted(configs, key=lambda config: -self.score(source, config))
+        active = [config for config in ranked if self._get(source, config)["skip_until"] <= now]
+        skipped = [config for config in ranked if self._get(source, config)["skip_until"] > now]
+        return active + skipped
+
+    def record_success(self, source: str, config: dict):
+        stat = self._get(source, config)
+        stat["success"] += 1
+        stat["streak"] = 0
+        stat["skip_until"] = 0.0
+
+    def record_failure(self, source: str, config: dict, error_class: str):
+        if error_class in VIDEO_ERROR_CLASSES:
+            return
+        
+        stat = self._get(source, config)
+        stat["failure"] += 1
+        stat["errors"][error_class] = stat["errors"].get(error_class, 0.0) + 1
+        stat["streak"] += 1
+        if stat["streak"] >= self.max_failures:
+            stat["skip_until"] = time.monotonic() + self.cooldown
+            print(f"[DEBUG] Конфигурация {client_config_key(config)} ({source}) отключена на {int(self.cooldown)} сек")
+
+client_strategy = ClientStrategySelector(STRATEGY_HALF_LIFE, STRATEGY_MAX_FAILURES, STRATEGY_COOLDOWN)
+
+# ================== DOWNLOAD EXECUTOR ==================
+class DuplicateVideoError(Exception):
+    """Видео уже публиковалось - загрузку медиа нужно прервать"""
+
+class DownloadDeferred(Exception):
+    """Задача далеко в бэклоге расписания - медиа скачает prefetcher ближе к слоту"""
+
+# Блокирующие вызовы yt-dlp выполняются в отдельном пуле, чтобы не замораживать event loop
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+DOWNLOAD_EXECUTOR = os.getenv("DOWNLOAD_EXECUTOR", "thread")  # thread | process
+
+# Сколько загрузок одного источника может идти одновременно
+SOURCE_CONCURRENCY = {
+    "youtube": int(os.getenv("YOUTUBE_CONCURRENCY", "2")),
+    "tiktok": int(os.getenv("TIKTOK_CONCURRENCY", "2")),
+    "vk": int(os.getenv("VK_CONCURRENCY", "2")),
+    "instagram": int(os.getenv("INSTAGRAM_CONCURRENCY", "1")),
+}
+
+if DOWNLOAD_EXECUTOR == "process":
+    download_executor = ProcessPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+else:
+    download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+
+source_semaphores = {source: asyncio.Semaphore(limit) for source, limit in SOURCE_CONCURRENCY.items()}
+
+# Hedged режим YouTube: сколько конфигураций клиентов извлекают метаданные одновременно (1 - выключен)
+# Гонка не занимает больше половины пула загрузок, чтобы проигравшие попытки не блокировали остальных
+YT_HEDGE_COUNT = min(int(os.getenv("YT_HEDGE_COUNT", "1")), max(1, DOWNLOAD_WORKERS // 2))
+# Короткие таймауты для попыток гонки: отмененная попытка быстро освобождает поток пула
+YT_HEDGE_SOCKET_TIMEOUT = int(os.getenv("YT_HEDGE_SOCKET_TIMEOUT", "15"))
+
+async def run_in_download_pool(func, *args):
+    """Выполняет блокирующую функцию в пуле загрузок (без лимита источника)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(download_executor, func, *args)
+
+async def run_download(source: str, func, *args):
+    """Выполняет блокирующую функцию в пуле загрузок с учетом лимита источника"""
+    async with source_semaphores[source]:
+        return await run_in_download_pool(func, *args)
+
+def build_base_opts(workdir: str) -> dict:
+    """Базовые опции yt-dlp, общие для всех источников"""
+    return {
+        "outtmpl": os.path.join(workdir, "video.mp4"),
+        "quiet": True,
+        "retries": 3,
+        "fragment-retries": 3,
+        "retry_sleep": 2,
+        "timeout": 120,
+        "socket_timeout": 120,
+        "nocheckcertificate": True,
+    }
+
+def build_youtube_configs(is_shorts: bool, cookies_valid: bool) -> list:
+    """Возвращает конфигурации клиентов YouTube в порядке приоритета"""
+    # Для Shorts используем приоритетно мобильные клиенты
+    if is_shorts:
+        configs_to_try = []
+        
+        # Если есть cookies, добавляем конфигурации с cookies в приоритете
+        if cookies_valid:
+            configs_to_try.extend([
+                # Конфигурация 1: Android с cookies (самый надежный)
+                {
+                    "client": ["android"],
+                    "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
+                    "use_extractor_args": True,
+                    "age_gate": False,
+                    "use_cookies": True,
+                },
+                # Конфигурация 2: iOS с cookies
+                {
+                    "client": ["ios"],
+                    "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
+                    "use_extractor_args": True,
+                    "age_gate": False,
+                    "use_cookies": True,
+                },
+                # Конфигурация 3: Android + iOS с cookies
+                {
+                    "client": ["android", "ios"],
+                    "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
+                    "use_extractor_args": True,
+                    "age_gate": False,
+                    "use_cookies": True,
+                },
+            ])
+        
+        # Добавляем конфигурации без cookies (или если cookies нет)
+        configs_to_try.extend([
+            # Конфигурация: Android клиент (лучше всего для Shorts)
+            {
+                "client": ["android"],
+                "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
+                "use_extractor_args": True,
+                "age_gate": False,
+                "use_cookies": cookies_valid,
+            },
+            # Конфигурация: iOS клиент
+            {
+                "client": ["ios"],
+                "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
+                "use_extractor_args": True,
+                "age_gate": False,
+                "use_cookies": cookies_valid,
+            },
+            # Конфигурация: Android + iOS комбинация
+            {
+                "client": ["android", "ios"],
+                "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
+                "use_extractor_args": True,
+                "age_gate": False,
+                "use_cookies": cookies_valid,
+            },
+            # Конфигурация: iOS + Android + mweb
+            {
+                "client": ["ios", "android", "mweb"],
+                "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
+                "use_extractor_args": True,
+                "age_gate": False,
+                "use_cookies": cookies_valid,
+            },
+            # Конфигурация: Mobile web
+            {
+                "client": ["mweb"],
+                "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
+                "use_extractor_args": True,
+                "age_gate": False,
+                "use_cookies": cookies_valid,
+            },
+            # Конфигурация: Android с обходом возрастных ограничений
+            {
+                "client": ["android"],
+                "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
+                "use_extractor_args": True,
+                "age_gate": True,
+                "use_cookies": cookies_valid,
+            },
+            # Конфигурация: iOS с обходом возрастных ограничений
+            {
+                "client": ["ios"],
+                "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
+                "use_extractor_args": True,
+                "age_gate": True,
+                "use_cookies": cookies_valid,
+            },
+            # Конфигурация: Desktop web
+            {
+                "client": ["web"],
+                "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+                "use_extractor_args": True,
+                "age_gate": False,
+                "use_cookies": cookies_valid,
+            },
+            # Конфигурация: Без extractor_args (иногда помогает)
+            {
+                "client": None,
+                "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+                "use_extractor_args": False,
+                "age_gate": False,
+                "use_cookies": cookies_valid,
+            },
+        ])
+    else:
+        configs_to_try = [
+            # Конфигурация 1: iOS клиент
+            {
+                "client": ["ios"],
+                "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
+                "use_extractor_args": True,
+                "age_gate": False,
+            },
+            # Конфигурация 2: Android клиент
+            {
+                "client": ["android"],
+                "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
+                "use_extractor_args": True,
+                "age_gate": False,
+            },
+            # Конфигурация 3: Mobile web
+            {
+                "client": ["mweb"],
+                "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
+                "use_extractor_args": True,
+                "age_gate": False,
+            },
+            # Конфигурация 4: Desktop web
+            {
+                "client": ["web"],
+                "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+                "use_extractor_args": True,
+                "age_gate": False,
+            },
+            # Конфигурация 5: Без extractor_args (иногда помогает)
+            {
+                "client": None,
+                "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+                "use_extractor_args": False,
+                "age_gate": False,
+            },
+            # Конфигурация 6: iOS + Android комбинация
+            {
+                "client": ["ios", "android"],
+                "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
+                "use_extractor_args": True,
+                "age_gate": False,
+            },
+        ]
+    
+    return configs_to_try
+
+def probe_video(text: str, ydl_opts: dict) -> dict:
+    """Извлекает метаданные видео без загрузки медиа (блокирующая)"""
+    with open_youtube_dl(ydl_opts) as ydl:
+        return ydl.extract_info(text, download=False)
+
+def download_from_info(info: dict, ydl_opts: dict) -> dict:
+    """Скачивает медиа по уже извлеченным метаданным без повторного извлечения (блокирующая)"""
+    with open_youtube_dl(ydl_opts) as ydl:
+        return ydl.process_ie_result(info, download=True)
+
+def extract_playlist_entries(url: str, limit: int, use_cookies: bool) -> list:
+    """Ссылки на видео плейлиста или канала без загрузки метаданных каждого видео (блокирующая)"""
+    ydl_opts = {
+        "quiet": True,
+        "extract_flat": "in_playlist",
+        "playlistend": limit,
+        "use_shared_cookies": use_cookies,
+    }
+    urls = []
+    with open_youtube_dl(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+        for entry in info.get("entries") or []:
+            if not entry:
+                continue
+            if is_nested_playlist(entry):
+                # Ссылка на канал без вкладки отдает вкладки (видео, Shorts, трансляции) -
+                # раскрываем их на один уровень, глубже не идем
+                tab_url = entry.get("url") or entry.get("webpage_url")
+                if entry.get("entries") is None and tab_url:
+                    entry = ydl.extract_info(tab_url, download=False)
+                items = entry.get("entries") or []
+            else:
+                items = [entry]
+            for item in items:
+                if not item or is_nested_playlist(item):
+                    continue
+                item_url = item.get("url") or item.get("webpage_url")
+                if item_url:
+                    urls.append(item_url)
+            if len(urls) >= limit:
+                break
+    return urls[:limit]
+
+def is_nested_playlist(entry: dict) -> bool:
+    """Элемент плейлиста - сам плейлист (например, вкладка канала), а не видео"""
+    return entry.get("_type") == "playlist" or entry.get("ie_key") == "YoutubeTab"
+
+def build_youtube_opts(config: dict, idx: int, workdir: str, is_shorts: bool, cookies_valid: bool) -> dict:
+    """Опции yt-dlp для одной конфигурации клиента YouTube"""
+    base_opts = build_base_opts(workdir)
+    
+    # Для Shorts используем более гибкий формат
+    if is_shorts:
+        # Пробуем разные форматы для Shorts
+        format_selector = "best[height<=1080][ext=mp4]/best[ext=mp4]/bestvideo[height<=1080]+bestaudio/best[height<=1080]/bestvideo+bestaudio/best"
+    else:
+        format_selector = "best[height<=1080][ext=mp4]/best[ext=mp4]/best"
+    
+    # Базовые заголовки
+    headers = {
+        "User-Agent": config["user_agent"],
+        "Accept": "*/*",
+        "Accept-Language": "en-US,en;q=0.9",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Referer": "https://www.youtube.com/",
+        "Origin": "https://www.youtube.com",
+    }
+    
+    # Для Shorts добавляем дополнительные заголовки
+    if is_shorts:
+        headers.update({
+            "X-YouTube-Client-Name": "1" if "android" in str(config.get("client", [])).lower() else "2",
+            "X-YouTube-Client-Version": "19.09.37" if "android" in str(config.get("client", [])).lower() else "17.33.2",
+        })
+    
+    ydl_opts = {
+        **base_opts,
+        "format": format_selector,
+        "merge_output_format": "mp4",
+        "noplaylist": True,  # Не скачивать плейлисты
+        "http_headers": headers,
+        "postprocessors": [
+            {
+                "key": "FFmpegVideoRemuxer",
+                "preferedformat": "mp4",
+            }
+        ],
+        "postprocessor_args": ["-movflags", "+faststart"],
+    }
+    
+    # Для Shorts добавляем дополнительные параметры
+    if is_shorts:
+        ydl_opts["extractor_args"] = ydl_opts.get("extractor_args", {})
+        ydl_opts["extractor_args"]["youtube"] = ydl_opts["extractor_args"].get("youtube", {})
+        
+        # Добавляем extractor_args только если нужно
+        if config["use_extractor_args"] and config["client"]:
+            ydl_opts["extractor_args"]["youtube"]["player_client"] = config["client"]
+        
+        # Обработка возрастных ограничений
+        if config.get("age_gate", False):
+            ydl_opts["extractor_args"]["youtube"]["skip"] = ["dash", "hls"]
+            ydl_opts["age_gate"] = False
+        
+        # Дополнительные параметры для обхода защиты Shorts
+        ydl_opts["no_warnings"] = False  # Показываем предупреждения для диагностики
+        ydl_opts["ignoreerrors"] = False  # Не игнорируем ошибки
+        ydl_opts["extract_flat"] = False  # Полное извлечение информации
+    else:
+        # Добавляем extractor_args только если нужно
+        if config["use_extractor_args"] and config["client"]:
+            ydl_opts["extractor_args"] = {
+                "youtube": {
+                    "player_client": config["client"],
+                }
+            }
+    
+    # Используем cookies если указано в конфигурации и файл валиден
+    if config.get("use_cookies", False) and cookies_valid:
+        ydl_opts["use_shared_cookies"] = True
+        print(f"[DEBUG] Используем cookies для попытки {idx + 1}")
+    elif not is_shorts:
+        # Для обычных видео используем cookies если есть
+        ydl_opts["use_shared_cookies"] = True
+    
+    return ydl_opts
+
+def has_playable_formats(info: dict) -> bool:
+    """Проверяет, что в метаданных выбран формат, который можно скачать"""
+    return bool(info.get("requested_formats") or info.get("url"))
+
+async def hedged_youtube_probe(text: str, candidates: list, workdir: str, is_shorts: bool, cookies_valid: bool, strategy_source: str) -> tuple:
+    """
+    Параллельно извлекает метаданные с несколькими конфигурациями клиентов.
+    Возвращает (config, ydl_opts, info) первой конфигурации с рабочими форматами, остальные отменяет
+    """
+    attempts = {}
+    last_error = None
+    pending = set()
+    # Гонка занимает один слот источника (берется до запуска попыток), а не по слоту на каждую
+    async with source_semaphores["youtube"]:
+        try:
+            for idx, config in enumerate(candidates):
+                ydl_opts = build_youtube_opts(config, idx, workdir, is_shorts, cookies_valid)
+                # Для извлечения метаданных - короткий таймаут и без повторов, для загрузки - обычные опции
+                probe_opts = {**ydl_opts, "socket_timeout": YT_HEDGE_SOCKET_TIMEOUT, "retries": 0, "extractor_retries": 0}
+                attempt = asyncio.create_task(run_in_download_pool(probe_video, text, probe_opts))
+                attempts[attempt] = (config, ydl_opts)
+                pending.add(attempt)
+            
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    config, ydl_opts = attempts[attempt]
+                    error = attempt.exception()
+                    if error is None and has_playable_formats(attempt.result()):
+                        print(f"[DEBUG] Hedged: победила конфигурация {client_config_key(config)}")
+                        return config, ydl_opts, attempt.result()
+                    
+                    last_error = error or DownloadError("No video formats found")
+                    client_strategy.record_failure(strategy_source, config, classify_download_error(str(last_error)))
+        finally:
+            # Потоки yt-dlp нельзя прервать, но их результаты больше не ждем
+            for attempt in pending:
+                attempt.cancel()
+    
+    raise last_error
+
+async def download_youtube(text: str, workdir: str, is_shorts: bool, cookies_valid: bool, on_metadata) -> tuple:
+    """Скачивает видео с YouTube, перебирая конфигурации клиентов"""
+    # Пробуем несколько методов обхода блокировки YouTube, начиная с тех, что сейчас работают
+    strategy_source = "youtube_shorts" if is_shorts else "youtube"
+    configs_to_try = client_strategy.order(strategy_source, build_youtube_configs(is_shorts, cookies_valid))
+    
+    info = None
+    video_id = None
+    last_error = None
+    tried_all = False
+    
+    # ---------- Hedged режим: гонка метаданных для первых N конфигураций ----------
+    start = 0
+    if YT_HEDGE_COUNT > 1:
+        hedged = configs_to_try[:YT_HEDGE_COUNT]
+        start = len(hedged)
+        config = None
+        try:
+            config, ydl_opts, info = await hedged_youtube_probe(text, hedged, workdir, is_shorts, cookies_valid, strategy_source)
+            await on_metadata(info)
+            # Медиа скачивается только один раз - с конфигурацией-победителем
+            info = await run_download("youtube", download_from_info, info, ydl_opts)
+            client_strategy.record_success(strategy_source, config)
+            return info, info.get("id")
+        except (DuplicateVideoError, DownloadDeferred):
+            raise
+        except Exception as e:
+            last_error = e
+            if config is not None:
+                client_strategy.record_failure(strategy_source, config, classify_download_error(str(e)))
+            # Ошибка самого видео - остальные конфигурации тоже не помогут
+            if classify_download_error(str(e)) in VIDEO_ERROR_CLASSES:
+                raise DownloadError(last_error)
+            print(f"[DEBUG] Hedged попытка не удалась, перебираем остальные конфигурации: {str(e)[:200]}")
+    
+    for idx, config in enumerate(configs_to_try[start:], start):
+        try:
+            # Отладочная информация для Shorts
+            if is_shorts:
+                print(f"[DEBUG] Shorts попытка {idx + 1}/{len(configs_to_try)}: клиент={config.get('client', 'None')}")
+            
+            ydl_opts = build_youtube_opts(config, idx, workdir, is_shorts, cookies_valid)
+            
+            # Сначала только метаданные: по ним сразу запускается генерация подписи
+            info = await run_download("youtube", probe_video, text, ydl_opts)
+            await on_metadata(info)
+            
+            # Затем медиа по уже полученным метаданным
+            info = await run_download("youtube", download_from_info, info, ydl_opts)
+            video_id = info.get("id")
+            client_strategy.record_success(strategy_source, config)
+            break  # Успешно скачали
+                
+        except (DuplicateVideoError, DownloadDeferred):
+            raise
+        except DownloadError as e:
+            last_error = e
+            err_str = str(e)
+            client_strategy.record_failure(strategy_source, config, classify_download_error(err_str))
+            # Отладочная информация для Shorts
+            if is_shorts:
+                print(f"[DEBUG] Shorts ошибка попытка {idx + 1}: {err_str[:200]}")
+            # Если это не ошибка связанная с защитой, не пробуем дальше
+            skip_errors = ["403", "Forbidden", "Failed to extract", "player response", "Sign in", "private video", "Unable to extract", "Video unavailable"]
+            # Для критических ошибок (не связанных с защитой) прерываем попытки
+            critical_errors = ["No video formats found", "Private video", "Video unavailable", "This video is not available"]
+            if any(crit_err in err_str for crit_err in critical_errors):
+                if is_shorts:
+                    print(f"[DEBUG] Shorts критическая ошибка, прерываем попытки")
+                break
+            # Если это не ошибка связанная с защитой YouTube, не пробуем дальше
+            if not any(err in err_str for err in skip_errors):
+                if is_shorts:
+                    print(f"[DEBUG] Shorts неизвестная ошибка, прерываем попытки")
+                break
+            # Если это последняя попытка
+            if idx == len(configs_to_try) - 1:
+                tried_all = True
+                if is_shorts:
+                    print(f"[DEBUG] Shorts все попытки исчерпаны")
+            continue
+        except Exception as e:
+            last_error = e
+            client_strategy.record_failure(strategy_source, config, "other")
+            if idx == len(configs_to_try) - 1:
+                tried_all = True
+            continue
+    
+    if video_id is None:
+        if tried_all:
+            raise DownloadError(last_error if last_error else "Не удалось скачать видео после всех попыток")
+        else:
+            raise DownloadError(last_error if last_error else "Не удалось скачать видео")
+    
+    return info, video_id
+
+def build_source_opts(source: str, workdir: str) -> dict:
+    """Опции yt-dlp для TikTok, Instagram и VK"""
+    base_opts = build_base_opts(workdir)
+    
+    if source == "tiktok":
+        return {
+            **base_opts,
+            "format": "mp4",
+            "extractor_args": {
+                "tiktok": {
+                    "webpage_download_timeout": 120,
+                }
+            },
+        }
+    
+    if source == "instagram":
+        return {
+            **base_opts,
+            "format": "best[ext=mp4]/best[height<=1080]/best",
+            "merge_output_format": "mp4",
+            "postprocessors": [
+                {
+                    "key": "FFmpegVideoRemuxer",
+                    "preferedformat": "mp4",
+                }
+            ],
+            "extractor_args": {
+                "instagram": {
+                    "webpage_download_timeout": 120,
+                }
+            },
+        }
+    
+    # VK
+    return {
+        **base_opts,
+        "format": "mp4",
+    }
+
+def get_video_id(info: dict, source: str, text: str) -> str:
+    """Возвращает video_id из метаданных yt-dlp"""
+    if source == "instagram":
+        # Для Instagram используем shortcode или id, или извлекаем из URL
+        video_id = info.get("shortcode") or info.get("id") or text.split("/")[-1].split("?")[0].split("/")[-1]
+        if not video_id:
+            # Fallback: извлекаем последнюю часть URL
+            video_id = text.strip("/").split("/")[-1].split("?")[0]
+        return video_id
+    
+    return info.get("id")
+
+async def download_video(text: str, source: str, workdir: str, is_shorts: bool, cookies_valid: bool, on_metadata) -> tuple:
+    """
+    Скачивает видео в папку задачи в два этапа: метаданные, затем медиа.
+    on_metadata(info) вызывается сразу после получения метаданных. Возвращает (info, video_id)
+    """
+    if source == "youtube":
+        return await download_youtube(text, workdir, is_shorts, cookies_valid, on_metadata)
+    
+    ydl_opts = build_source_opts(source, workdir)
+    info = await run_download(source, probe_video, text, ydl_opts)
+    await on_metadata(info)
+    info = await run_download(source, download_from_info, info, ydl_opts)
+    return info, get_video_id(info, source, text)
+
+async def download_stage(job: dict) -> bool:
+    """Этап загрузки: скачивает видео задачи в пуле загрузок. True - передать задачу дальше"""
+    # Незавершенная загрузка после перезапуска начинается заново в чистой папке
+    cleanup_job_workspace(job.get("workdir"))
+    # Загрузка начинается, только когда на диске есть место (резерв снимает stage_worker)
+    await admission.reserve(job)
+    workdir = create_job_workspace()
+    update_job(job, state=JOB_DOWNLOADING, workdir=workdir, video_path=os.path.join(workdir, "video.mp4"), disk_bytes=0)
+    
+    text = job["url"]
+    source = job["source"]
+    is_shorts = bool(job["is_shorts"])
+    cookies_valid = bool(job["cookies_valid"])
+    
+    # ---------- Ранняя проверка дубликатов по id из ссылки (без запросов к сайту) ----------
+    early_video_id = extract_video_id(text, source)
+    if early_video_id and is_video_posted(early_video_id):
+        update_job(job, state=JOB_FAILED, video_id=early_video_id, error="duplicate")
+        await notify_user(job, "⚠️ Это видео уже публиковалось ранее. Дубликаты не допускаются.")
+        return False
+    
+    async def on_metadata(info: dict):
+        # Проверка по метаданным - до загрузки медиа
+        probed_video_id = get_video_id(info, source, text)
+        if is_video_posted(probed_video_id):
+            raise DuplicateVideoError(probed_video_id)
+        # Подпись зависит только от метаданных, поэтому начинаем ее до окончания загрузки медиа
+        start_speculative_caption(job, info)
+        # За пределами окна prefetch медиа не скачивается: на диск оно попадет ближе к слоту
+        if publish_scheduler.should_defer(job):
+            update_job(job, video_id=probed_video_id, info=compact_info(info))
+            raise DownloadDeferred(probed_video_id)
+    
+    # ---------- Download ----------
+    try:
+        info, video_id = await download_video(text, source, job["workdir"], is_shorts, cookies_valid, on_metadata)
+    
+    except DuplicateVideoError as e:
+        update_job(job, state=JOB_FAILED, video_id=str(e), error="duplicate")
+        await notify_user(job, "⚠️ Это видео уже публиковалось ранее. Дубликаты не допускаются.")
+        return False
+    
+    except DownloadDeferred:
+        # Задача ждет в бэклоге только с подписью, папка с частичной загрузкой не нужна
+        caption_task = job.pop("caption_task", None)
+        llm_content = await caption_task if caption_task else await generate_caption_with_llm(job["info"] or {}, source)
+        update_job(job, state=JOB_SCHEDULED, caption=llm_content, disk_bytes=0)
+        cleanup_job_workspace(job["workdir"])
+        publish_scheduler.restore(job)
+        await notify_user(job, "✅ Видео добавлено в очередь обработки")
+        return False
+    
+    except (DownloadError, Exception) as e:
+        err = str(e)
+        update_job(job, state=JOB_FAILED, error=err[:1000])
+
+        if source == "tiktok" and "100004" in err:
+            await notify_user(job, 
+                "🚫 TikTok ограничил доступ к этому видео.\n"
+                "Попробуй другое."
+            )
+            return False
+
+        if source == "tiktok":
+            await notify_user(job, 
+                "❌ TikTok временно не отвечает.\n"
+                "Попробуй ещё раз через 10–20 секунд."
+            )
+        elif source == "instagram":
+            await notify_user(job, 
+                "❌ Ошибка скачивания с Instagram.\n\n"
+                "💡 Возможные причины:\n"
+                "• Видео недоступно или приватное\n"
+                "• Instagram временно ограничил доступ\n"
+                "• Попробуй другую ссылку или подожди несколько минут"
+            )
+        elif source == "youtube":
+            # Определяем, была ли это попытка скачать Shorts
+            is_shorts = "/shorts/" in text or "youtube.com/shorts" in text
+            
+            if "403" in err or "Forbidden" in err:
+                if is_shorts:
+                    await notify_user(job, 
+                        "🚫 YouTube Shorts заблокировал доступ.\n\n"
+                        "💡 Решения:\n"
+                        "• Экспортируй cookies из браузера в файл 'youtube_cookies.txt'\n"
+                        "• Обнови yt-dlp: pip install -U yt-dlp\n"
+                        "• Попробуй позже или другую ссылку"
+                    )
+                else:
+                    await notify_user(job, 
+                        "🚫 YouTube заблокировал доступ после всех попыток.\n\n"
+                        "💡 Решения:\n"
+                        "• Экспортируй cookies из браузера в файл 'youtube_cookies.txt'\n"
+                        "• Обнови yt-dlp: pip install -U yt-dlp\n"
+                        "• Попробуй позже или другую ссылку"
+                    )
+            elif "Failed to extract" in err or "player response" in err or "Unable to extract" in err or "Sign in" in err:
+                if is_shorts:
+                    # Формируем информативное сообщение
+                    cookies_status = "✅ Найден" if cookies_valid else "❌ Не найден или невалиден"
+                    attempts_info = f"Попробовано методов: {len(build_youtube_configs(is_shorts, cookies_valid))}"
+                    
+                    error_msg = (
+                        f"⚠️ Не удалось скачать YouTube Shorts после всех попыток.\n\n"
+                        f"📊 Статус:\n"
+                        f"   • Cookies: {cookies_status}\n"
+                        f"   • {attempts_info}\n\n"
+                        f"🔧 Решения:\n"
+                    )
+                    
+                    if not cookies_valid:
+                        error_msg += (
+                            f"1️⃣ Экспортируй cookies (ВАЖНО!):\n"
+                            f"   • Установи расширение 'Get cookies.txt LOCALLY'\n"
+                            f"   • Зайди на youtube.com и авторизуйся\n"
+                            f"   • Экспортируй cookies в файл 'youtube_cookies.txt'\n"
+                            f"   • Загрузи файл в папку с ботом\n"
+                            f"   • Убедись, что файл содержит данные (не пустой)\n\n"
+                        )
+                    
+                    error_msg += (
+                        f"2️⃣ Обнови yt-dlp до последней версии:\n"
+                        f"   pip install -U yt-dlp\n\n"
+                        f"3️⃣ Проверь:\n"
+                        f"   • Доступно ли видео (не приватное, не удалено)\n"
+                        f"   • Подожди 5-10 минут и попробуй снова\n"
+                        f"   • Попробуй другую ссылку на Shorts\n\n"
+                        f"💡 Если проблема сохраняется, проверь логи бота для деталей."
+                    )
+                    
+                    await notify_user(job, error_msg)
+                else:
+                    await notify_user(job, 
+                        "⚠️ YouTube изменил защиту.\n\n"
+                        "🔧 Для Railway обнови yt-dlp:\n"
+                        "1. В файле requirements.txt укажи:\n"
+                        "   yt-dlp>=2025.12.8\n"
+                        "2. Или через Railway CLI:\n"
+                        "   railway run pip install -U yt-dlp\n"
+                        "3. Перезапусти деплой\n\n"
+                        "💡 Или попробуй:\n"
+                        "• Другую ссылку\n"
+                        "• Подождать несколько минут\n"
+                        "• Экспортировать cookies в 'youtube_cookies.txt'"
+                    )
+            else:
+                await notify_user(job, f"❌ Ошибка скачивания: {e}")
+        else:
+            await notify_user(job, f"❌ Ошибка скачивания: {e}")
+
+        print(f"[DEBUG] yt-dlp error: {e}")
+        return False
+
+    # ---------- Дополнительная проверка дубликатов по video_id ----------
+    if is_video_posted(video_id):
+        update_job(job, state=JOB_FAILED, video_id=video_id, error="duplicate")
+        await notify_user(job, "⚠️ Это видео уже публиковалось ранее. Дубликаты не допускаются.")
+        return False
+
+    # ---------- Нормализация медиа (stream copy, перекодирование только при необходимости) ----------
+    if source in NORMALIZE_SOURCES:
+        try:
+            await normalize_media(job["video_path"])
+        except Exception as e:
+            # Файл остается как есть: Telegram обычно принимает и его
+            print(f"[DEBUG] Ошибка нормализации: {e}")
+
+    # ---------- Лимит размера Telegram ----------
+    size = os.path.getsize(job["video_path"])
+    if size > TELEGRAM_UPLOAD_LIMIT:
+        await notify_user(job, f"🗜 Видео больше лимита Telegram ({size / 1024 / 1024:.0f} МБ), сжимаю...")
+        try:
+            size = await shrink_to_limit(job["video_path"], info.get("duration"))
+            print(f"[DEBUG] Видео сжато до {size / 1024 / 1024:.1f} МБ")
+        except Exception as e:
+            update_job(job, state=JOB_FAILED, video_id=video_id, error=f"shrink: {e}"[:1000])
+            await notify_user(job, f"❌ Видео слишком большое для Telegram и не удалось его сжать: {e}")
+            return False
+
+    # ---------- Передаем на этап подписи ----------
+    # Повторная загрузка (после вытеснения из кэша) уже с подписью - без лишних сообщений
+    prepared_before = bool(job["caption"])
+    update_job(job, state=JOB_CAPTIONING, video_id=video_id, info=compact_info(info), disk_bytes=get_workspace_size(job["workdir"]))
+    if not prepared_before:
+        await notify_user(job, "✅ Видео добавлено в очередь обработки")
+    return True
+
+# ================== BULK INGEST ==================
+# Много ссылок в одном сообщении, .txt файл со ссылками или плейлист/канал
+# ставятся в очередь одним пакетом с общим сообщением о прогрессе
+BULK_MAX_LINKS = int(os.getenv("BULK_MAX_LINKS", "50"))
+BULK_EXPAND_PLAYLISTS = os.getenv("BULK_EXPAND_PLAYLISTS", "1").lower() in ("1", "true", "yes")
+PLAYLIST_MAX_ITEMS = int(os.getenv("PLAYLIST_MAX_ITEMS", "25"))
+BULK_DOCUMENT_MAX_BYTES = 1024 * 1024
+# Не чаще одного редактирования сообщения о прогрессе за интервал (кроме финального)
+BATCH_PROGRESS_INTERVAL = 5
+URL_REGEX = r"(?:https?://)?(?:[\w-]+\.)+[a-z]{2,}/[^\s<>\"']*"
+
+batch_progress_updates = {}
+
+def extract_urls(text: str) -> list:
+    """Все поддерживаемые ссылки из текста (в порядке появления)"""
+    return [url.rstrip(".,;)") for url in re.findall(URL_REGEX, text, re.IGNORECASE) if detect_source(url) or get_short_link_host(url)]
+
+async def read_document_urls(msg: types.Message):
+    """Ссылки из приложенного .txt файла (None - файл не подходит, пользователь уже уведомлен)"""
+    document = msg.document
+    if not (document.file_name or "").lower().endswith(".txt") and document.mime_type != "text/plain":
+        await msg.answer("❌ Поддерживаются только .txt файлы со ссылками")
+        return None
+    if document.file_size and document.file_size > BULK_DOCUMENT_MAX_BYTES:
+        await msg.answer("❌ Файл слишком большой (максимум 1 МБ)")
+        return None
+    
+    data = await bot.download(document)
+    return extract_urls(data.read().decode("utf-8", errors="ignore"))
+
+async def expand_batch_urls(urls: list, cookies_valid: bool) -> tuple:
+    """Раскрывает короткие ссылки и плейлисты. Возвращает (ссылки, число ошибок раскрытия)"""
+    urls = await asyncio.gather(*(http_client.resolve(url) for url in urls))
+    expanded = []
+    failed = 0
+    for url in urls:
+        source = detect_source(url)
+        if not (BULK_EXPAND_PLAYLISTS and source and is_playlist_url(url, source)):
+            expanded.append(url)
+            continue
+        try:
+            entries = await run_download(source, extract_playlist_entries, url, PLAYLIST_MAX_ITEMS, source == "youtube" and cookies_valid)
+            print(f"[DEBUG] Плейлист {url}: {len(entries)} видео")
+            expanded.extend(entries)
+        except Exception as e:
+            print(f"[DEBUG] Ошибка раскрытия плейлиста {url}: {e}")
+            failed += 1
+    return expanded, failed
+
+def create_batch(chat_id: int, message_id: int, total: int) -> int:
+    with db_lock, db:
+        cursor = db.execute(
+            "INSERT INTO batches (chat_id, message_id, total, created_at) VALUES (?, ?, ?, ?)",
+            (chat_id, message_id, total, time.time())
+        )
+        return cursor.lastrowid
+
+async def submit_batch(msg: types.Message, urls: list):
+    """Проверяет ссылки пакета, отбрасывает дубликаты и ставит остальные в очередь"""
+    status = await msg.answer(f"📦 Обрабатываю ссылки ({len(urls)})...")
+    cookies_valid = youtube_cookies.has_valid()
+    urls, failed = await expand_batch_urls(urls, cookies_valid)
+    
+    accepted = []
+    seen = set()
+    skipped = {"unsupported": failed, "duplicate": 0, "posted": 0, "limit": 0}
+    # Пакет принимается только в пределах свободного места в очереди
+    max_accepted = min(BULK_MAX_LINKS, admission.capacity())
+    for url in urls:
+        source = detect_source(url)
+        if source is None:
+            skipped["unsupported"] += 1
+            continue
+        
+        # Дубликаты внутри пакета и уже опубликованные видео
+        normalized_url = normalize_url(url, source)
+        if normalized_url in seen:
+            skipped["duplicate"] += 1
+            continue
+        seen.add(normalized_url)
+        
+        video_id = extract_video_id(url, source)
+        if is_link_posted(normalized_url) or (video_id and is_video_posted(video_id)):
+            skipped["posted"] += 1
+            continue
+        
+        if len(accepted) >= max_accepted:
+            skipped["limit"] += 1
+            continue
+        accepted.append((url, source, normalized_url))
+    
+    skipped_text = (
+        f"Пропущено: дубликаты в пакете - {skipped['duplicate']}, уже публиковались - {skipped['posted']}, "
+        f"неподдерживаемые - {skipped['unsupported']}, сверх лимита {max_accepted} - {skipped['limit']}"
+    )
+    if not accepted:
+        if max_accepted == 0:
+            await status.edit_text("🚫 Очередь переполнена. Попробуй отправить ссылки позже.")
+        else:
+            await status.edit_text(f"⚠️ В пакете нет новых ссылок.\n{skipped_text}")
+        return
+    
+    batch_id = create_batch(msg.chat.id, status.message_id, len(accepted))
+    deferred_text = "\n⏳ Диск сейчас занят - загрузки начнутся по мере освобождения места." if admission.check(0) == ADMIT_DEFER else ""
+    await status.edit_text(f"📦 Пакет #{batch_id}: в очереди {len(accepted)} видео.\n{skipped_text}{deferred_text}")
+    
+    for url, source, normalized_url in accepted:
+        is_shorts = source == "youtube" and "/shorts/" in url
+        job = create_job(url, source, normalized_url, msg.chat.id, is_shorts, source == "youtube" and cookies_valid, batch_id, msg.from_user.id)
+        download_queue.put_nowait(job)
+
+async def update_batch_progress(batch_id: int):
+    """Обновляет общее сообщение о прогрессе пакета (после завершения каждой задачи)"""
+    rows = db_execute("SELECT * FROM batches WHERE id = ?", (batch_id,))
+    if not rows:
+        return
+    batch = dict(rows[0])
+    
+    counts = {"done": 0, "duplicate": 0, "failed": 0}
+    for row in db_execute("SELECT state, error FROM jobs WHERE batch_id = ?", (batch_id,)):
+        if row["state"] == JOB_DONE:
+            counts["done"] += 1
+        elif row["state"] == JOB_FAILED:
+            counts["duplicate" if row["error"] == "duplicate" else "failed"] += 1
+    finished = sum(counts.values())
+    
+    # Промежуточные обновления не чаще интервала, финальное - всегда
+    now = time.monotonic()
+    if finished < batch["total"] and now - batch_progress_updates.get(batch_id, 0) < BATCH_PROGRESS_INTERVAL:
+        return
+    batch_progress_updates[batch_id] = now
+    
+    text = (
+        f"📦 Пакет #{batch_id}: {finished}/{batch['total']}\n"
+        f"✅ Опубликовано: {counts['done']}\n"
+        f"⚠️ Дубликаты: {counts['duplicate']}\n"
+        f"❌ Ошибки: {counts['failed']}"
+    )
+    if finished >= batch["total"]:
+        batch_progress_updates.pop(batch_id, None)
+        text += "\n\n🏁 Пакет обработан"
+        errors = db_execute(
+            "SELECT url, error FROM jobs WHERE batch_id = ? AND state = ? AND error != 'duplicate' ORDER BY id LIMIT 10",
+            (batch_id, JOB_FAILED)
+        )
+        if errors:
+            text += "\n\n" + "\n".join(f"• {row['url']}: {(row['error'] or '')[:100]}" for row in errors)
+    
+    try:
+        await bot.edit_message_text(text, chat_id=batch["chat_id"], message_id=batch["message_id"], disable_web_page_preview=True)
+    except Exception as e:
+        print(f"[DEBUG] Batch progress error (batch {batch_id}): {e}")
+
+# ================== HANDLER ==================
+@dp.message()
+async def handler(msg: types.Message):
+    if msg.from_user.id not in ALLOWED_USERS:
+        return
+
+    if not msg.text and not msg.document:
+        return
+
+    text = (msg.text or msg.caption or "").strip()
+
+    # ---------- /start ----------
     if text.startswith("/start"):
         welcome_msg = (
             "🎬 Кидай ссылку:\n"
             "• YouTube Shorts\n"
             "• TikTok\n"
             "• VK / VK Video\n"
-            "• Instagram (посты, рилсы, IGTV, сторис)"
+            "• Instagram (посты, рилсы, IGTV, сторис)\n\n"
+            "📦 Можно прислать несколько ссылок сразу, .txt файл со ссылками или плейлист/канал"
         )
         
         # Добавляем информацию для администраторов
@@ -450,7 +2580,10 @@ async def handler(msg: types.Message):
                 "👑 Админ команды:\n"
                 "/add_user <ID> - добавить пользователя\n"
                 "/remove_user <ID> - удалить пользователя\n"
-                "/list_users - список пользователей"
+                "/list_users - список пользователей\n"
+                "/channels - каналы и правила публикации\n"
+                "/schedule [слоты|off] - расписание публикаций\n"
+                "/queue [prio <ID> <N>|remove <ID>] - очередь публикаций"
             )
         
         await msg.answer(welcome_msg)
@@ -510,651 +2643,824 @@ async def handler(msg: types.Message):
             await msg.answer(f"📋 Разрешенные пользователи ({len(users)}):\n\n{users_text}")
             return
 
-    # ---------- Источник ----------
-    if re.search(YT_REGEX, text):
-        source = "youtube"
-    elif re.search(TT_REGEX, text):
-        source = "tiktok"
-    elif re.search(VK_REGEX, text):
-        source = "vk"
-    elif re.search(IG_REGEX, text):
-        source = "instagram"
+        # ---------- /channels ----------
+        if text.startswith("/channels"):
+            if not CHANNELS:
+                await msg.answer("📋 Каналы не настроены")
+                return
+            
+            lines = []
+            for channel in CHANNELS:
+                rules = []
+                if channel.get("sources"):
+                    rules.append("источники: " + ", ".join(channel["sources"]))
+                if channel["tags"]:
+                    rules.append("теги: " + ", ".join(channel["tags"]))
+                if channel.get("submitters"):
+                    rules.append("отправители: " + ", ".join(str(uid) for uid in channel["submitters"]))
+                lines.append(f"📢 {channel['name']} ({channel['chat_id']})\n   " + ("; ".join(rules) or "все видео"))
+            await msg.answer(f"📋 Каналы ({len(CHANNELS)}):\n\n" + "\n".join(lines))
+            return
+
+        # ---------- /schedule ----------
+        if text.startswith("/schedule"):
+            parts = text.split(maxsplit=1)
+            if len(parts) == 2:
+                spec = "" if parts[1].strip().lower() == "off" else parts[1]
+                try:
+                    publish_scheduler.set_slots(spec)
+                except ValueError as e:
+                    await msg.answer(f"❌ {e}\nПример: /schedule 09:00-23:00/30, 23:30")
+                    return
+            
+            if not publish_scheduler.slots:
+                await msg.answer("🗓 Расписание выключено: видео публикуются сразу после обработки")
+                return
+            
+            upcoming = ", ".join(f"{slot:%d.%m %H:%M}" for slot in publish_scheduler.next_slots(5))
+            await msg.answer(
+                f"🗓 Расписание: {publish_scheduler.spec} ({len(publish_scheduler.slots)} слотов в день)\n"
+                f"⏭ Ближайшие слоты: {upcoming}"
+            )
+            return
+
+        # ---------- /queue ----------
+        if text.startswith("/queue"):
+            parts = text.split()
+            try:
+                if len(parts) == 4 and parts[1] == "prio":
+                    job = publish_scheduler.find(int(parts[2]))
+                    if job is None:
+                        await msg.answer(f"⚠️ Задачи {parts[2]} нет в очереди")
+                        return
+                    update_job(job, priority=int(parts[3]))
+                    job["last_used"] = time.monotonic()
+                    prefetcher.wake()
+                    await msg.answer(f"✅ Приоритет задачи {job['id']}: {job['priority']}")
+                    return
+                if len(parts) == 3 and parts[1] == "remove":
+                    job = publish_scheduler.remove(int(parts[2]))
+                    await msg.answer(f"✅ Задача {parts[2]} удалена" if job else f"⚠️ Задачи {parts[2]} нет в очереди")
+                    return
+            except ValueError:
+                await msg.answer("❌ ID и приоритет должны быть числами")
+                return
+            
+            backlog = publish_scheduler.ordered()
+            if not backlog:
+                await msg.answer("📋 Очередь публикаций пуста")
+                return
+            
+            slots = publish_scheduler.next_slots(len(backlog))
+            lines = []
+            for job, slot in zip(backlog, slots):
+                title = (job.get("caption") or {}).get("title") or job["url"]
+                prio = f" ⬆️{job['priority']}" if job.get("priority") else ""
+                staged = "💾" if job.get("staged") else "☁️"
+                lines.append(f"{slot:%d.%m %H:%M} — {staged} #{job['id']} [{job['source']}]{prio} {title[:60]}")
+            staged_mb = prefetcher.staged_bytes() / 1024 / 1024
+            await msg.answer(
+                f"📋 Очередь публикаций ({len(backlog)}), на диске {staged_mb:.0f}/{prefetcher.budget / 1024 / 1024:.0f} МБ:\n\n"
+                + "\n".join(lines[:30])
+            )
+            return
+
+    # ---------- Несколько ссылок, плейлисты и .txt файлы - пакетом ----------
+    urls = extract_urls(text)
+    if msg.document:
+        document_urls = await read_document_urls(msg)
+        if document_urls is None:
+            return
+        urls += document_urls
+    
+    if len(urls) > 1 or msg.document or (BULK_EXPAND_PLAYLISTS and urls and is_playlist_url(urls[0], detect_source(urls[0]))):
+        await submit_batch(msg, urls)
+        return
+    
+    if urls:
+        text = urls[0]
+
+    # ---------- Короткие ссылки (нужно сделать до определения источника и нормализации) ----------
+    text = await http_client.resolve(text)
+
+    # ---------- Источник ----------
+    source = detect_source(text)
+    if source is None:
+        await msg.answer("❌ Неподдерживаемая ссылка")
+        return
+
+    # ---------- Проверка дубликатов по ссылке ----------
+    normalized_url = normalize_url(text, source)
+    if is_link_posted(normalized_url):
+        await msg.answer("⚠️ Эта ссылка уже была обработана ранее. Видео с этой ссылкой уже публиковалось в канале.")
+        return
+
+    # ---------- Контроль нагрузки ----------
+    decision = await admission.admit()
+    if decision == ADMIT_FULL:
+        await msg.answer("🚫 Очередь переполнена. Попробуй отправить ссылку позже.")
+        return
+    if decision == ADMIT_DEFER:
+        await msg.answer(f"⏳ Ссылка принята ({source}). Диск сейчас занят - загрузка начнется, когда освободится место.")
+    else:
+        await msg.answer(f"⏳ Загружаю ({source})...")
+
+    # ---------- Определяем, является ли это Shorts (для YouTube) ----------
+    is_shorts = False
+    cookies_valid = False
+    if source == "youtube":
+        is_shorts = "/shorts/" in text or "youtube.com/shorts" in text
+        
+        # Проверяем валидность cookies заранее (файлы уже разобраны в памяти)
+        cookies_valid = youtube_cookies.has_valid()
+
+    # ---------- Загрузка в фоне ----------
+    # Задача сохраняется в базе, хендлер сразу возвращается, загрузка идет в пуле
+    job = create_job(text, source, normalized_url, msg.chat.id, is_shorts, cookies_valid, submitter_id=msg.from_user.id)
+    download_queue.put_nowait(job)
+
+# ================== PUBLISH RATE LIMIT ==================
+# Публикация ограничивается token bucket на каждый чат вместо фиксированных пауз:
+# пока лимит не исчерпан, посты уходят сразу, а flood wait от Telegram замедляет чат
+PUBLISH_RATE_PER_MINUTE = float(os.getenv("PUBLISH_RATE_PER_MINUTE", "20"))
+PUBLISH_BURST = int(os.getenv("PUBLISH_BURST", "3"))
+PUBLISH_MAX_RETRIES = int(os.getenv("PUBLISH_MAX_RETRIES", "3"))
+# Отправлять отправителю само опубликованное видео (по file_id, без повторной загрузки)
+PUBLISH_PREVIEW = os.getenv("PUBLISH_PREVIEW", "0").lower() in ("1", "true", "yes")
+
+class TokenBucket:
+    """Token bucket одного чата с адаптивным замедлением после flood wait"""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.base_rate = rate_per_minute / 60
+        self.rate = self.base_rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        # asyncio.Lock будит ожидающих по очереди, поэтому отправки чередуются честно (FIFO)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет, пока в ведре появится токен, и забирает его"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_flood_wait(self, retry_after: float):
+        """Telegram вернул RetryAfter: блокируем чат и вдвое снижаем скорость"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        self.tokens = 0
+        self.rate = max(self.base_rate / 8, self.rate / 2)
+
+    def on_success(self):
+        """Успешная отправка: понемногу возвращаем скорость к настроенной"""
+        self.rate = min(self.base_rate, self.rate + self.base_rate / 10)
+
+publish_buckets = {}
+
+def get_publish_bucket(chat_id) -> TokenBucket:
+    """Возвращает token bucket чата (создает при первом обращении)"""
+    if chat_id not in publish_buckets:
+        publish_buckets[chat_id] = TokenBucket(PUBLISH_RATE_PER_MINUTE, PUBLISH_BURST)
+    return publish_buckets[chat_id]
+
+async def send_rate_limited(method, chat_id, **kwargs):
+    """Вызывает метод отправки bot.* через token bucket чата, повторяя после flood wait"""
+    bucket = get_publish_bucket(chat_id)
+    for attempt in range(PUBLISH_MAX_RETRIES + 1):
+        await bucket.acquire()
+        try:
+            result = await method(chat_id=chat_id, **kwargs)
+            bucket.on_success()
+            return result
+        except TelegramRetryAfter as e:
+            if attempt == PUBLISH_MAX_RETRIES:
+                raise
+            print(f"[DEBUG] Flood wait {e.retry_after} сек для чата {chat_id}")
+            bucket.on_flood_wait(e.retry_after)
+
+# ================== CHANNELS ==================
+# Реестр каналов с правилами: видео скачивается и подписывается один раз, затем
+# публикуется во все подходящие каналы (первая загрузка файла, дальше - по file_id).
+# Формат channels.json:
+# [{"chat_id": "@channel", "name": "Юмор", "link": "https://t.me/channel",
+#   "sources": ["tiktok", "youtube"], "tags": ["cats"], "submitters": [123456],
+#   "rate_per_minute": 20, "burst": 3}]
+# Пустое или отсутствующее правило (sources/tags/submitters) пропускает любые видео.
+
+def load_channels() -> list:
+    """Загружает реестр каналов из CHANNELS_FILE или собирает один канал из CHANNEL_ID"""
+    if os.path.exists(CHANNELS_FILE):
+        with open(CHANNELS_FILE, "r", encoding="utf-8") as f:
+            channels = json.load(f)
+    elif CHANNEL_ID:
+        channels = [{"chat_id": CHANNEL_ID, "name": "main", "link": CHANNEL_LINK}]
     else:
-        await msg.answer("❌ Неподдерживаемая ссылка")
-        return
+        channels = []
+    
+    for channel in channels:
+        channel["chat_id"] = str(channel["chat_id"])
+        channel.setdefault("name", channel["chat_id"])
+        channel.setdefault("link", CHANNEL_LINK)
+        channel["tags"] = [tag.lower().lstrip("#") for tag in channel.get("tags", [])]
+        # У каждого канала свой token bucket со своими лимитами
+        publish_buckets[channel["chat_id"]] = TokenBucket(
+            channel.get("rate_per_minute", PUBLISH_RATE_PER_MINUTE),
+            channel.get("burst", PUBLISH_BURST),
+        )
+    
+    print(f"[DEBUG] Каналов в реестре: {len(channels)}")
+    return channels
 
-    # ---------- TikTok redirect (нужно сделать до нормализации) ----------
-    if source == "tiktok":
-        text = await expand_tiktok_url(text)
+CHANNELS = load_channels()
 
-    # ---------- Проверка дубликатов по ссылке ----------
-    normalized_url = normalize_url(text, source)
-    if is_link_posted(normalized_url):
-        await msg.answer("⚠️ Эта ссылка уже была обработана ранее. Видео с этой ссылкой уже публиковалось в канале.")
-        return
+def get_job_tags(job: dict) -> set:
+    """Теги видео из метаданных и хэштеги подписи"""
+    tags = {str(tag).lower() for tag in (job.get("info") or {}).get("tags") or []}
+    hashtags = (job.get("caption") or {}).get("hashtags", "")
+    tags.update(tag.lower().lstrip("#") for tag in hashtags.split() if tag.startswith("#"))
+    return tags
 
-    await msg.answer(f"⏳ Загружаю ({source})...")
+def channel_matches(channel: dict, job: dict) -> bool:
+    """Проверяет правила канала: источник, теги и отправитель"""
+    if channel.get("sources") and job["source"] not in channel["sources"]:
+        return False
+    # Старые задачи без submitter_id сверяются по чату (в личке он совпадает с id автора)
+    submitter_id = job.get("submitter_id") or job["chat_id"]
+    if channel.get("submitters") and submitter_id not in channel["submitters"]:
+        return False
+    if channel["tags"] and not get_job_tags(job).intersection(channel["tags"]):
+        return False
+    return True
 
-    # ---------- Определяем, является ли это Shorts (для YouTube) ----------
-    is_shorts = False
-    cookies_valid = False
-    if source == "youtube":
-        is_shorts = "/shorts/" in text or "youtube.com/shorts" in text
-        
-        # Проверяем валидность cookies файла заранее
-        cookies_file = "youtube_cookies.txt"
-        has_cookies = os.path.exists(cookies_file)
-        if has_cookies:
-            try:
-                with open(cookies_file, "r", encoding="utf-8") as f:
-                    cookies_content = f.read()
-                    # Проверяем, что файл не пустой и содержит нужные данные
-                    if cookies_content.strip() and ("youtube.com" in cookies_content or "domain" in cookies_content.lower()):
-                        cookies_valid = True
-                        print(f"[DEBUG] Cookies файл найден и валиден ({len(cookies_content)} символов)")
-                    else:
-                        print(f"[DEBUG] Cookies файл пустой или невалидный")
-            except Exception as e:
-                print(f"[DEBUG] Ошибка чтения cookies: {e}")
-                cookies_valid = False
+def get_posted_channels(video_id: str) -> set:
+    return {row[0] for row in db_execute("SELECT chat_id FROM channel_posts WHERE video_id = ?", (video_id,))}
 
-    # ---------- Download ----------
+def add_channel_post(video_id: str, chat_id: str, message_id: int):
+    db_execute(
+        "INSERT OR IGNORE INTO channel_posts (video_id, chat_id, message_id, posted_at) VALUES (?, ?, ?, ?)",
+        (video_id, chat_id, message_id, time.time()),
+    )
+
+def get_send_method(kind: str):
+    """Метод отправки по file_id того же типа, что вернул Telegram при первой загрузке"""
+    return {"animation": bot.send_animation, "document": bot.send_document}.get(kind, bot.send_video)
+
+async def publish_to_channel(channel: dict, job: dict, video, thumbnail: bytes = None, kind: str = "video"):
+    """Отправляет видео (файл или file_id типа kind) в один канал и запоминает публикацию"""
+    # Заголовок - кликабельная ссылка на канал (HTML форматирование)
+    title_text = job["caption"]["title"]
+    send_kwargs = {
+        kind: video,
+        "caption": f'<a href="{channel["link"]}">{title_text}</a>',
+        "parse_mode": "HTML"
+    }
+    if kind == "video":
+        send_kwargs["supports_streaming"] = True
+    if thumbnail:
+        send_kwargs["thumbnail"] = types.BufferedInputFile(thumbnail, filename="thumbnail.jpg")
+    if isinstance(video, FfmpegStreamInputFile):
+        send_kwargs.update(get_stream_video_meta(job.get("info") or {}))
+    
+    sent_message = await send_rate_limited(get_send_method(kind), channel["chat_id"], **send_kwargs)
+    add_channel_post(job["video_id"], channel["chat_id"], sent_message.message_id)
+    print(f"[DEBUG] Опубликовано в {channel['name']}: {job['video_id']}")
+    return sent_message
+
+async def send_poll_to_channel(channel: dict, llm_content: dict, sent_message):
+    """Опрос под постом (каждый 5-й пост), через тот же лимит чата, что и видео"""
+    poll_options = llm_content.get("poll_options", [])
+    if not llm_content.get("poll_question") or len(poll_options) < 2:
+        return
     try:
-        # ---------- yt-dlp options ----------
-        base_opts = {
-            "outtmpl": "video.mp4",
-            "quiet": True,
-            "retries": 3,
-            "fragment-retries": 3,
-            "retry_sleep": 2,
-            "timeout": 120,
-            "socket_timeout": 120,
-            "nocheckcertificate": True,
-        }
+        await send_rate_limited(
+            bot.send_poll,
+            channel["chat_id"],
+            question=llm_content["poll_question"],
+            # Ограничиваем до 4 вариантов (лимит Telegram)
+            options=poll_options[:4],
+            is_anonymous=False,
+            reply_to_message_id=sent_message.message_id
+        )
+    except Exception as poll_error:
+        print(f"[DEBUG] Poll error ({channel['name']}): {poll_error}")
 
-        if source == "youtube":
-            
-            # Пробуем несколько методов обхода блокировки YouTube
-            cookies_file = "youtube_cookies.txt"
-            has_cookies = os.path.exists(cookies_file)
-            
-            # Для Shorts используем приоритетно мобильные клиенты
-            if is_shorts:
-                # Список конфигураций для Shorts (мобильные клиенты в приоритете)
-                # Если есть валидные cookies, пробуем их использовать в первую очередь
-                configs_to_try = []
-                
-                # Если есть cookies, добавляем конфигурации с cookies в приоритете
-                if cookies_valid:
-                    configs_to_try.extend([
-                        # Конфигурация 1: Android с cookies (самый надежный)
-                        {
-                            "client": ["android"],
-                            "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
-                            "use_extractor_args": True,
-                            "age_gate": False,
-                            "use_cookies": True,
-                        },
-                        # Конфигурация 2: iOS с cookies
-                        {
-                            "client": ["ios"],
-                            "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
-                            "use_extractor_args": True,
-                            "age_gate": False,
-                            "use_cookies": True,
-                        },
-                        # Конфигурация 3: Android + iOS с cookies
-                        {
-                            "client": ["android", "ios"],
-                            "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
-                            "use_extractor_args": True,
-                            "age_gate": False,
-                            "use_cookies": True,
-                        },
-                    ])
-                
-                # Добавляем конфигурации без cookies (или если cookies нет)
-                configs_to_try.extend([
-                    # Конфигурация: Android клиент (лучше всего для Shorts)
-                    {
-                        "client": ["android"],
-                        "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
-                        "use_extractor_args": True,
-                        "age_gate": False,
-                        "use_cookies": cookies_valid,
-                    },
-                    # Конфигурация: iOS клиент
-                    {
-                        "client": ["ios"],
-                        "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
-                        "use_extractor_args": True,
-                        "age_gate": False,
-                        "use_cookies": cookies_valid,
-                    },
-                    # Конфигурация: Android + iOS комбинация
-                    {
-                        "client": ["android", "ios"],
-                        "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
-                        "use_extractor_args": True,
-                        "age_gate": False,
-                        "use_cookies": cookies_valid,
-                    },
-                    # Конфигурация: iOS + Android + mweb
-                    {
-                        "client": ["ios", "android", "mweb"],
-                        "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
-                        "use_extractor_args": True,
-                        "age_gate": False,
-                        "use_cookies": cookies_valid,
-                    },
-                    # Конфигурация: Mobile web
-                    {
-                        "client": ["mweb"],
-                        "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
-                        "use_extractor_args": True,
-                        "age_gate": False,
-                        "use_cookies": cookies_valid,
-                    },
-                    # Конфигурация: Android с обходом возрастных ограничений
-                    {
-                        "client": ["android"],
-                        "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
-                        "use_extractor_args": True,
-                        "age_gate": True,
-                        "use_cookies": cookies_valid,
-                    },
-                    # Конфигурация: iOS с обходом возрастных ограничений
-                    {
-                        "client": ["ios"],
-                        "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
-                        "use_extractor_args": True,
-                        "age_gate": True,
-                        "use_cookies": cookies_valid,
-                    },
-                    # Конфигурация: Desktop web
-                    {
-                        "client": ["web"],
-                        "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                        "use_extractor_args": True,
-                        "age_gate": False,
-                        "use_cookies": cookies_valid,
-                    },
-                    # Конфигурация: Без extractor_args (иногда помогает)
-                    {
-                        "client": None,
-                        "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                        "use_extractor_args": False,
-                        "age_gate": False,
-                        "use_cookies": cookies_valid,
-                    },
-                ])
-            else:
-                # Список конфигураций для обычных видео (в порядке приоритета)
-                configs_to_try = [
-                        # Конфигурация 1: iOS клиент
-                        {
-                            "client": ["ios"],
-                            "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
-                            "use_extractor_args": True,
-                            "age_gate": False,
-                        },
-                        # Конфигурация 2: Android клиент
-                        {
-                            "client": ["android"],
-                            "user_agent": "com.google.android.youtube/19.09.37 (Linux; U; Android 11) gzip",
-                            "use_extractor_args": True,
-                            "age_gate": False,
-                        },
-                        # Конфигурация 3: Mobile web
-                        {
-                            "client": ["mweb"],
-                            "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
-                            "use_extractor_args": True,
-                            "age_gate": False,
-                        },
-                        # Конфигурация 4: Desktop web
-                        {
-                            "client": ["web"],
-                            "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                            "use_extractor_args": True,
-                            "age_gate": False,
-                        },
-                        # Конфигурация 5: Без extractor_args (иногда помогает)
-                        {
-                            "client": None,
-                            "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                            "use_extractor_args": False,
-                            "age_gate": False,
-                        },
-                        # Конфигурация 6: iOS + Android комбинация
-                        {
-                            "client": ["ios", "android"],
-                            "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1",
-                            "use_extractor_args": True,
-                            "age_gate": False,
-                        },
-                    ]
-            
-            video_id = None
-            last_error = None
-            tried_all = False
-            
-            for idx, config in enumerate(configs_to_try):
-                try:
-                    # Отладочная информация для Shorts
-                    if is_shorts:
-                        print(f"[DEBUG] Shorts попытка {idx + 1}/{len(configs_to_try)}: клиент={config.get('client', 'None')}")
-                    
-                    # Для Shorts используем более гибкий формат
-                    if is_shorts:
-                        # Пробуем разные форматы для Shorts
-                        format_selector = "best[height<=1080][ext=mp4]/best[ext=mp4]/bestvideo[height<=1080]+bestaudio/best[height<=1080]/bestvideo+bestaudio/best"
-                    else:
-                        format_selector = "best[height<=1080][ext=mp4]/best[ext=mp4]/best"
-                    
-                    # Базовые заголовки
-                    headers = {
-                        "User-Agent": config["user_agent"],
-                        "Accept": "*/*",
-                        "Accept-Language": "en-US,en;q=0.9",
-                        "Accept-Encoding": "gzip, deflate, br",
-                        "Referer": "https://www.youtube.com/",
-                        "Origin": "https://www.youtube.com",
-                    }
-                    
-                    # Для Shorts добавляем дополнительные заголовки
-                    if is_shorts:
-                        headers.update({
-                            "X-YouTube-Client-Name": "1" if "android" in str(config.get("client", [])).lower() else "2",
-                            "X-YouTube-Client-Version": "19.09.37" if "android" in str(config.get("client", [])).lower() else "17.33.2",
-                        })
-                    
-                    ydl_opts = {
-                        **base_opts,
-                        "format": format_selector,
-                        "merge_output_format": "mp4",
-                        "noplaylist": True,  # Не скачивать плейлисты
-                        "http_headers": headers,
-                        "postprocessors": [
-                            {
-                                "key": "FFmpegVideoRemuxer",
-                                "preferedformat": "mp4",
-                            }
-                        ],
-                        "postprocessor_args": ["-movflags", "+faststart"],
-                    }
-                    
-                    # Для Shorts добавляем дополнительные параметры
-                    if is_shorts:
-                        ydl_opts["extractor_args"] = ydl_opts.get("extractor_args", {})
-                        ydl_opts["extractor_args"]["youtube"] = ydl_opts["extractor_args"].get("youtube", {})
-                        
-                        # Добавляем extractor_args только если нужно
-                        if config["use_extractor_args"] and config["client"]:
-                            ydl_opts["extractor_args"]["youtube"]["player_client"] = config["client"]
-                        
-                        # Обработка возрастных ограничений
-                        if config.get("age_gate", False):
-                            ydl_opts["extractor_args"]["youtube"]["skip"] = ["dash", "hls"]
-                            ydl_opts["age_gate"] = False
-                        
-                        # Дополнительные параметры для обхода защиты Shorts
-                        ydl_opts["no_warnings"] = False  # Показываем предупреждения для диагностики
-                        ydl_opts["ignoreerrors"] = False  # Не игнорируем ошибки
-                        ydl_opts["extract_flat"] = False  # Полное извлечение информации
-                    else:
-                        # Добавляем extractor_args только если нужно
-                        if config["use_extractor_args"] and config["client"]:
-                            ydl_opts["extractor_args"] = {
-                                "youtube": {
-                                    "player_client": config["client"],
-                                }
-                            }
-                    
-                    # Используем cookies если указано в конфигурации и файл валиден
-                    if config.get("use_cookies", False) and cookies_valid:
-                        ydl_opts["cookiefile"] = cookies_file
-                        print(f"[DEBUG] Используем cookies для попытки {idx + 1}")
-                    elif has_cookies and not is_shorts:
-                        # Для обычных видео используем cookies если есть
-                        ydl_opts["cookiefile"] = cookies_file
-                    
-                    with YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(text, download=True)
-                        video_id = info.get("id")
-                        break  # Успешно скачали
-                        
-                except DownloadError as e:
-                    last_error = e
-                    err_str = str(e)
-                    # Отладочная информация для Shorts
-                    if is_shorts:
-                        print(f"[DEBUG] Shorts ошибка попытка {idx + 1}: {err_str[:200]}")
-                    # Если это не ошибка связанная с защитой, не пробуем дальше
-                    skip_errors = ["403", "Forbidden", "Failed to extract", "player response", "Sign in", "private video", "Unable to extract", "Video unavailable"]
-                    # Для критических ошибок (не связанных с защитой) прерываем попытки
-                    critical_errors = ["No video formats found", "Private video", "Video unavailable", "This video is not available"]
-                    if any(crit_err in err_str for crit_err in critical_errors):
-                        if is_shorts:
-                            print(f"[DEBUG] Shorts критическая ошибка, прерываем попытки")
-                        break
-                    # Если это не ошибка связанная с защитой YouTube, не пробуем дальше
-                    if not any(err in err_str for err in skip_errors):
-                        if is_shorts:
-                            print(f"[DEBUG] Shorts неизвестная ошибка, прерываем попытки")
+# ================== SCHEDULER ==================
+# Публикация по слотам расписания: задачи заранее скачиваются, подписываются и получают
+# обложку, затем ждут в бэклоге (состояние хранится в базе), а в момент слота остается
+# только отправка. Без слотов видео публикуются сразу, как раньше.
+# Формат слотов: "09:00-23:00/30" (каждые 30 минут с 9 до 23) и/или "12:00", через запятую
+SCHEDULE_SLOTS = os.getenv("SCHEDULE_SLOTS", "")
+SCHEDULE_TZ = os.getenv("SCHEDULE_TZ", "Europe/Moscow")
+
+try:
+    schedule_tz = ZoneInfo(SCHEDULE_TZ)
+except ZoneInfoNotFoundError:
+    print(f"[DEBUG] Часовой пояс {SCHEDULE_TZ} не найден, используется локальное время")
+    schedule_tz = None
+
+def parse_slots(spec: str) -> list:
+    """Разбирает описание слотов в отсортированный список минут от начала суток"""
+    minutes = set()
+    for part in spec.replace(" ", "").split(","):
+        if not part:
+            continue
+        match = re.fullmatch(r"(\d{1,2}):(\d{2})(?:-(\d{1,2}):(\d{2})/(\d+))?", part)
+        if not match:
+            raise ValueError(f"неверный слот: {part}")
+        if int(match.group(2)) >= 60 or (match.group(4) is not None and int(match.group(4)) >= 60):
+            raise ValueError(f"минуты должны быть меньше 60: {part}")
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        if match.group(3) is None:
+            minutes.add(start)
+            continue
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        step = int(match.group(5))
+        if step <= 0:
+            raise ValueError(f"неверный интервал: {part}")
+        if max(start, end) >= 24 * 60:
+            raise ValueError("время должно быть меньше 24:00")
+        # Диапазон через полночь ("23:00-02:00/30") продолжается в следующих сутках
+        if end < start:
+            end += 24 * 60
+        minutes.update(minute % (24 * 60) for minute in range(start, end + 1, step))
+    
+    if any(minute >= 24 * 60 for minute in minutes):
+        raise ValueError("время должно быть меньше 24:00")
+    return sorted(minutes)
+
+class PublishScheduler:
+    """Бэклог готовых к публикации задач, который отдает их в publish_queue по слотам"""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        self.slots = parse_slots(spec)
+        self.backlog = []
+        self.changed = asyncio.Event()
+        self.last_slot = None
+
+    def now(self) -> datetime:
+        return datetime.now(schedule_tz)
+
+    def set_slots(self, spec: str):
+        """Меняет расписание (сохраняется в базе и переживает перезапуск)"""
+        self.slots = parse_slots(spec)
+        self.spec = spec
+        db_execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schedule_slots', ?)", (spec,))
+        self.changed.set()
+
+    def next_slots(self, count: int) -> list:
+        """Ближайшие count слотов после последнего сработавшего"""
+        if not self.slots:
+            return []
+        after = max(self.now(), self.last_slot) if self.last_slot else self.now()
+        result = []
+        day = after.replace(hour=0, minute=0, second=0, microsecond=0)
+        while len(result) < count:
+            for minute in self.slots:
+                slot = day + timedelta(minutes=minute)
+                if slot > after:
+                    result.append(slot)
+                    if len(result) == count:
                         break
-                    # Если это последняя попытка
-                    if idx == len(configs_to_try) - 1:
-                        tried_all = True
-                        if is_shorts:
-                            print(f"[DEBUG] Shorts все попытки исчерпаны")
-                    continue
-                except Exception as e:
-                    last_error = e
-                    if idx == len(configs_to_try) - 1:
-                        tried_all = True
-                    continue
-            
-            if video_id is None:
-                if tried_all:
-                    raise DownloadError(last_error if last_error else "Не удалось скачать видео после всех попыток")
-                else:
-                    raise DownloadError(last_error if last_error else "Не удалось скачать видео")
-
-        elif source == "tiktok":
-            ydl_opts = {
-                **base_opts,
-                "format": "mp4",
-                "extractor_args": {
-                    "tiktok": {
-                        "webpage_download_timeout": 120,
-                    }
-                },
-            }
-            
-            with YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(text, download=True)
-                video_id = info.get("id")
+            day += timedelta(days=1)
+        return result
 
-        elif source == "instagram":
-            ydl_opts = {
-                **base_opts,
-                "format": "best[ext=mp4]/best[height<=1080]/best",
-                "merge_output_format": "mp4",
-                "postprocessors": [
-                    {
-                        "key": "FFmpegVideoRemuxer",
-                        "preferedformat": "mp4",
-                    }
-                ],
-                "postprocessor_args": ["-c:v", "libx264", "-preset", "fast", "-crf", "23", "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart"],
-                "extractor_args": {
-                    "instagram": {
-                        "webpage_download_timeout": 120,
-                    }
-                },
-            }
-            
-            with YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(text, download=True)
-                # Для Instagram используем shortcode или id, или извлекаем из URL
-                video_id = info.get("shortcode") or info.get("id") or text.split("/")[-1].split("?")[0].split("/")[-1]
-                if not video_id:
-                    # Fallback: извлекаем последнюю часть URL
-                    video_id = text.strip("/").split("/")[-1].split("?")[0]
-
-        else:  # VK
-            ydl_opts = {
-                **base_opts,
-                "format": "mp4",
-            }
-            
-            with YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(text, download=True)
-                video_id = info.get("id")
+    def ordered(self) -> list:
+        """Бэклог в порядке публикации: по приоритету, затем по времени добавления"""
+        # Задачи, которые упали при повторной загрузке, из бэклога уходят
+        self.backlog = [job for job in self.backlog if job["state"] not in JOB_FINAL_STATES]
+        return sorted(self.backlog, key=lambda job: (-(job.get("priority") or 0), job["id"]))
 
-    except (DownloadError, Exception) as e:
-        err = str(e)
+    def next_staged(self):
+        """Первая по порядку задача, у которой все готово к отправке"""
+        return next((job for job in self.ordered() if job.get("staged")), None)
 
-        if source == "tiktok" and "100004" in err:
-            await msg.answer(
-                "🚫 TikTok ограничил доступ к этому видео.\n"
-                "Попробуй другое."
-            )
+    async def put(self, job: dict):
+        """Вызывается этапом обложки вместо publish_queue.put"""
+        # Задачу убрали из расписания, пока она скачивалась - обратно она не возвращается
+        if job.get("removed") or job["state"] in JOB_FINAL_STATES:
+            return
+        if not self.slots:
+            if job in self.backlog:
+                self.backlog.remove(job)
+            await publish_queue.put(job)
+            # Освободилось место в окне - следующие задачи без файлов тоже пора скачивать
+            prefetcher.wake()
             return
+        update_job(job, state=JOB_SCHEDULED)
+        job["staged"] = True
+        job["prefetching"] = False
+        job["staged_bytes"] = job.get("disk_bytes") or 0
+        job["last_used"] = time.monotonic()
+        if self.find(job["id"]) is None:
+            self.backlog.append(job)
+        self.changed.set()
+        prefetcher.wake()
 
-        if source == "tiktok":
-            await msg.answer(
-                "❌ TikTok временно не отвечает.\n"
-                "Попробуй ещё раз через 10–20 секунд."
-            )
-        elif source == "instagram":
-            await msg.answer(
-                "❌ Ошибка скачивания с Instagram.\n\n"
-                "💡 Возможные причины:\n"
-                "• Видео недоступно или приватное\n"
-                "• Instagram временно ограничил доступ\n"
-                "• Попробуй другую ссылку или подожди несколько минут"
-            )
-        elif source == "youtube":
-            # Определяем, была ли это попытка скачать Shorts
-            is_shorts = "/shorts/" in text or "youtube.com/shorts" in text
-            
-            if "403" in err or "Forbidden" in err:
-                if is_shorts:
-                    await msg.answer(
-                        "🚫 YouTube Shorts заблокировал доступ.\n\n"
-                        "💡 Решения:\n"
-                        "• Экспортируй cookies из браузера в файл 'youtube_cookies.txt'\n"
-                        "• Обнови yt-dlp: pip install -U yt-dlp\n"
-                        "• Попробуй позже или другую ссылку"
-                    )
-                else:
-                    await msg.answer(
-                        "🚫 YouTube заблокировал доступ после всех попыток.\n\n"
-                        "💡 Решения:\n"
-                        "• Экспортируй cookies из браузера в файл 'youtube_cookies.txt'\n"
-                        "• Обнови yt-dlp: pip install -U yt-dlp\n"
-                        "• Попробуй позже или другую ссылку"
-                    )
-            elif "Failed to extract" in err or "player response" in err or "Unable to extract" in err or "Sign in" in err:
-                if is_shorts:
-                    # Формируем информативное сообщение
-                    cookies_status = "✅ Найден" if cookies_valid else "❌ Не найден или невалиден"
-                    attempts_info = "Попробовано несколько методов"
-                    try:
-                        attempts_info = f"Попробовано методов: {len(configs_to_try)}"
-                    except:
-                        pass
-                    
-                    error_msg = (
-                        f"⚠️ Не удалось скачать YouTube Shorts после всех попыток.\n\n"
-                        f"📊 Статус:\n"
-                        f"   • Cookies: {cookies_status}\n"
-                        f"   • {attempts_info}\n\n"
-                        f"🔧 Решения:\n"
-                    )
-                    
-                    if not cookies_valid:
-                        error_msg += (
-                            f"1️⃣ Экспортируй cookies (ВАЖНО!):\n"
-                            f"   • Установи расширение 'Get cookies.txt LOCALLY'\n"
-                            f"   • Зайди на youtube.com и авторизуйся\n"
-                            f"   • Экспортируй cookies в файл 'youtube_cookies.txt'\n"
-                            f"   • Загрузи файл в папку с ботом\n"
-                            f"   • Убедись, что файл содержит данные (не пустой)\n\n"
-                        )
-                    
-                    error_msg += (
-                        f"2️⃣ Обнови yt-dlp до последней версии:\n"
-                        f"   pip install -U yt-dlp\n\n"
-                        f"3️⃣ Проверь:\n"
-                        f"   • Доступно ли видео (не приватное, не удалено)\n"
-                        f"   • Подожди 5-10 минут и попробуй снова\n"
-                        f"   • Попробуй другую ссылку на Shorts\n\n"
-                        f"💡 Если проблема сохраняется, проверь логи бота для деталей."
-                    )
-                    
-                    await msg.answer(error_msg)
-                else:
-                    await msg.answer(
-                        "⚠️ YouTube изменил защиту.\n\n"
-                        "🔧 Для Railway обнови yt-dlp:\n"
-                        "1. В файле requirements.txt укажи:\n"
-                        "   yt-dlp>=2025.12.8\n"
-                        "2. Или через Railway CLI:\n"
-                        "   railway run pip install -U yt-dlp\n"
-                        "3. Перезапусти деплой\n\n"
-                        "💡 Или попробуй:\n"
-                        "• Другую ссылку\n"
-                        "• Подождать несколько минут\n"
-                        "• Экспортировать cookies в 'youtube_cookies.txt'"
-                    )
-            else:
-                await msg.answer(f"❌ Ошибка скачивания: {e}")
-        else:
-            await msg.answer(f"❌ Ошибка скачивания: {e}")
+    def should_defer(self, job: dict) -> bool:
+        """Новая задача попадет в бэклог за пределами окна prefetch"""
+        if not self.slots or job.get("prefetching") or job["caption"]:
+            return False
+        key = (-(job.get("priority") or 0), job["id"])
+        ahead = sum(1 for other in self.ordered() if (-(other.get("priority") or 0), other["id"]) < key)
+        return ahead >= prefetcher.ahead
 
-        print(f"[DEBUG] yt-dlp error: {e}")
-        if os.path.exists("video.mp4"):
-            os.remove("video.mp4")
-        return
+    def restore(self, job: dict):
+        """Задача в бэклоге без файлов (вытеснена, после перезапуска или не скачана) - их скачает prefetcher"""
+        job["staged"] = False
+        self.backlog.append(job)
+        prefetcher.wake()
 
-    # ---------- Дополнительная проверка дубликатов по video_id ----------
-    with open(POSTED_FILE, "r", encoding="utf-8") as f:
-        posted_video_ids = set(line.strip() for line in f if line.strip())
-        if video_id in posted_video_ids:
-            await msg.answer("⚠️ Это видео уже публиковалось ранее. Дубликаты не допускаются.")
-            if os.path.exists("video.mp4"):
-                os.remove("video.mp4")
-            return
+    def find(self, job_id: int):
+        return next((job for job in self.backlog if job["id"] == job_id), None)
 
-    # ---------- Добавляем в очередь ----------
-    await video_queue.put({
-        "video_path": "video.mp4",
-        "video_id": video_id,
-        "normalized_url": normalized_url,
-        "source": source,
-        "info": info,
-        "user_msg": msg
-    })
-    
-    await msg.answer("✅ Видео добавлено в очередь обработки")
-
-# ================== QUEUE PROCESSOR ==================
-async def process_video_queue():
-    """Обрабатывает очередь видео"""
-    while True:
-        try:
-            task = await video_queue.get()
-            
-            video_path = task["video_path"]
-            video_id = task["video_id"]
-            normalized_url = task["normalized_url"]
-            source = task["source"]
-            info = task["info"]
-            user_msg = task["user_msg"]
+    def remove(self, job_id: int):
+        """Убирает задачу из бэклога (папка задачи удаляется)"""
+        job = self.find(job_id)
+        if job is None:
+            return None
+        self.backlog.remove(job)
+        # Флаг видят этапы, если задача сейчас повторно скачивается prefetcher'ом
+        job["removed"] = True
+        update_job(job, state=JOB_FAILED, error="removed from schedule")
+        cleanup_job_workspace(job["workdir"])
+        prefetcher.wake()
+        return job
+
+    async def run(self):
+        # Целевой слот запоминается между ожиданиями и пересчитывается только при смене
+        # расписания - иначе пробуждение в момент слота сдвигало бы его на следующий
+        slot = None
+        slot_spec = None
+        while True:
+            self.changed.clear()
             
-            # Проверяем существование видео
-            if not os.path.exists(video_path):
-                await user_msg.answer("❌ Файл видео не найден")
-                video_queue.task_done()
+            # Расписание выключили - все, что ждало, публикуется сразу (невыгруженное - после загрузки)
+            if not self.slots:
+                job = self.next_staged()
+                while job is not None:
+                    self.backlog.remove(job)
+                    await publish_queue.put(job)
+                    job = self.next_staged()
+                prefetcher.wake()
+                slot = None
+                await self.changed.wait()
                 continue
             
-            # ---------- Генерация подписи через LLM ----------
-            await user_msg.answer("🤖 Генерирую креативную подпись...")
-            
-            llm_content = await generate_caption_with_llm(info, source)
-            
-            # Формируем финальную подпись (только заголовок-ссылка)
-            title_text = llm_content["title"]
-            # Делаем заголовок кликабельной ссылкой на канал (HTML форматирование)
-            clickable_title = f'<a href="https://t.me/smeshnoto4ka">{title_text}</a>'
-            final_caption = clickable_title
-            
-            # ---------- Создание обложки ----------
-            thumbnail_path = None
-            if os.path.exists(video_path):
-                thumbnail_path = await create_thumbnail(video_path)
+            if slot is None or slot_spec != self.slots:
+                slot = self.next_slots(1)[0]
+                slot_spec = self.slots
+            delay = (slot - self.now()).total_seconds()
+            if delay > 0:
+                try:
+                    # Пробуждение раньше слота - если поменяли расписание
+                    await asyncio.wait_for(self.changed.wait(), timeout=min(delay, 60))
+                except asyncio.TimeoutError:
+                    pass
+                continue
             
-            # ---------- Публикация ----------
+            self.last_slot = slot
+            # Задача, которую не успели подготовить, не задерживает слот - идет следующая готовая
+            job = self.next_staged()
+            if job is not None:
+                self.backlog.remove(job)
+                print(f"[DEBUG] Слот {slot:%H:%M}: публикуется задача {job['id']}")
+                await publish_queue.put(job)
+                prefetcher.wake()
+            elif self.backlog:
+                print(f"[DEBUG] Слот {slot:%H:%M} пропущен: нет подготовленных задач")
+            slot = None
+
+# ================== PREFETCH ==================
+# Полностью подготовленными (видео, обложка, подпись) держатся ближайшие PREFETCH_AHEAD
+# задач бэклога. Если файлы бэклога превышают бюджет диска, у задач за пределами этого окна
+# файлы удаляются, начиная с давно не используемых (LRU); подпись остается в базе,
+# а видео скачается снова, когда задача приблизится к своему слоту. Новые задачи за пределами
+# окна вовсе не скачиваются сразу: после метаданных и подписи они ждут в бэклоге без файлов
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD", "5"))
+STAGING_BUDGET = int(float(os.getenv("STAGING_BUDGET_MB", "2048")) * 1024 * 1024)
+
+class Prefetcher:
+    """Держит подготовленными ближайшие задачи бэклога в рамках бюджета диска"""
+
+    def __init__(self, ahead: int, budget: int):
+        self.ahead = ahead
+        self.budget = budget
+        self.event = asyncio.Event()
+
+    def wake(self):
+        self.event.set()
+
+    def staged_bytes(self) -> int:
+        return sum(job.get("staged_bytes", 0) for job in publish_scheduler.backlog if job.get("staged"))
+
+    def evict(self, job: dict):
+        """Удаляет файлы задачи; подпись и метаданные остаются в базе"""
+        cleanup_job_workspace(job["workdir"])
+        update_job(job, disk_bytes=0)
+        job["staged"] = False
+        job["thumbnail"] = None
+        job["staged_bytes"] = 0
+        admission.notify()
+        print(f"[DEBUG] Вытеснены файлы задачи {job['id']} (вне окна prefetch)")
+
+    def rebalance(self):
+        ordered = publish_scheduler.ordered()
+        window = ordered[:self.ahead]
+        
+        # Ближайшие задачи без файлов - в очередь загрузки
+        for job in window:
+            if not job.get("staged") and not job.get("prefetching"):
+                job["prefetching"] = True
+                job["last_used"] = time.monotonic()
+                print(f"[DEBUG] Prefetch задачи {job['id']}")
+                download_queue.put_nowait(job)
+        
+        # Сверх бюджета - освобождаем место за пределами окна
+        total = self.staged_bytes()
+        if total > self.budget:
+            self.free_space(total - self.budget)
+
+    def free_space(self, needed: int) -> int:
+        """Вытесняет задачи за пределами окна, начиная с LRU, пока не освободит needed байт"""
+        ordered = publish_scheduler.ordered()
+        window_ids = {job["id"] for job in ordered[:self.ahead]}
+        candidates = [job for job in ordered if job.get("staged") and job["id"] not in window_ids]
+        freed = 0
+        for job in sorted(candidates, key=lambda job: job.get("last_used", 0)):
+            if freed >= needed:
+                break
+            freed += job.get("staged_bytes", 0)
+            self.evict(job)
+        return freed
+
+    async def run(self):
+        while True:
+            await self.event.wait()
+            self.event.clear()
             try:
-                video_file = types.FSInputFile(video_path)
-                send_kwargs = {
-                    "chat_id": CHANNEL_ID,
-                    "video": video_file,
-                    "caption": final_caption,
-                    "supports_streaming": True,
-                    "parse_mode": "HTML"
-                }
-                
-                # Добавляем обложку если есть
-                if thumbnail_path and os.path.exists(thumbnail_path):
-                    send_kwargs["thumbnail"] = types.FSInputFile(thumbnail_path)
-                
-                sent_message = await bot.send_video(**send_kwargs)
-                
-                # ---------- Сохранение данных ----------
-                with open(POSTED_FILE, "a", encoding="utf-8") as f:
-                    f.write(video_id + "\n")
-                
-                add_link_to_posted(normalized_url)
-                post_count = increment_post_count()
-                
-                # ---------- Создание опроса (каждый 5-й пост) ----------
-                if should_create_poll() and llm_content.get("poll_question"):
-                    await asyncio.sleep(2)  # Небольшая задержка перед опросом
-                    try:
-                        poll_options = llm_content.get("poll_options", [])
-                        if len(poll_options) >= 2:
-                            # Ограничиваем до 4 вариантов (лимит Telegram)
-                            poll_options = poll_options[:4]
-                            
-                            await bot.send_poll(
-                                chat_id=CHANNEL_ID,
-                                question=llm_content["poll_question"],
-                                options=poll_options,
-                                is_anonymous=False,
-                                reply_to_message_id=sent_message.message_id
-                            )
-                    except Exception as poll_error:
-                        print(f"[DEBUG] Poll error: {poll_error}")
-                
-                # ---------- Очистка ----------
-                if os.path.exists(video_path):
-                    os.remove(video_path)
-                if thumbnail_path and os.path.exists(thumbnail_path):
-                    os.remove(thumbnail_path)
-                
-                await user_msg.answer(f"✅ Опубликовано (пост #{post_count})")
-                
-                # ⏸ паузы против блокировок
-                await asyncio.sleep(4 if source == "youtube" else 6)
-                
+                self.rebalance()
             except Exception as e:
-                await user_msg.answer(f"❌ Ошибка при отправке в канал: {e}")
-                print(f"[DEBUG] Publication error: {e}")
-                if os.path.exists(video_path):
-                    os.remove(video_path)
-                if thumbnail_path and os.path.exists(thumbnail_path):
-                    os.remove(thumbnail_path)
-            
-            video_queue.task_done()
-            
+                print(f"[DEBUG] Prefetch error: {e}")
+
+# Бэклог не может занимать больше, чем пускает admission: иначе загрузки ждали бы места вечно
+if STAGING_BUDGET > ADMISSION_MAX_BYTES:
+    print(f"[DEBUG] STAGING_BUDGET_MB больше ADMISSION_MAX_MB, бюджет бэклога уменьшен до {ADMISSION_MAX_BYTES / 1024 / 1024:.0f} МБ")
+prefetcher = Prefetcher(PREFETCH_AHEAD, min(STAGING_BUDGET, ADMISSION_MAX_BYTES))
+
+_saved_slots = db_execute("SELECT value FROM meta WHERE key = 'schedule_slots'")
+try:
+    publish_scheduler = PublishScheduler(_saved_slots[0][0] if _saved_slots else SCHEDULE_SLOTS)
+except ValueError as e:
+    print(f"[DEBUG] Ошибка в расписании ({e}), публикация без слотов")
+    publish_scheduler = PublishScheduler("")
+
+# ================== PIPELINE STAGES ==================
+def start_speculative_caption(job: dict, info: dict):
+    """Запускает генерацию подписи в фоне по метаданным, пока скачивается медиа"""
+    if job.get("caption") or job.get("caption_task"):
+        return
+    job["caption_task"] = asyncio.create_task(generate_caption_with_llm(compact_info(info), job["source"]))
+
+def cancel_speculative_caption(job: dict):
+    """Отменяет фоновую генерацию подписи, если задача не дойдет до публикации"""
+    task = job.pop("caption_task", None)
+    if task and not task.done():
+        task.cancel()
+
+async def caption_stage(job: dict) -> bool:
+    """Этап подписи: генерирует подпись через LLM (один раз на задачу)"""
+    # Видео могло быть опубликовано прямо перед перезапуском
+    if is_video_posted(job["video_id"]):
+        update_job(job, state=JOB_DONE)
+        return False
+    
+    # Проверяем существование видео
+    if not os.path.exists(job["video_path"]):
+        update_job(job, state=JOB_FAILED, error="video file not found")
+        await notify_user(job, "❌ Файл видео не найден")
+        return False
+    
+    # ---------- Генерация подписи через LLM ----------
+    # Подпись сохраняется в задаче, поэтому после перезапуска LLM не вызывается повторно
+    if not job["caption"]:
+        caption_task = job.pop("caption_task", None)
+        if caption_task:
+            # Подпись уже генерируется с момента получения метаданных - просто дожидаемся ее
+            llm_content = await caption_task
+        else:
+            await notify_user(job, "🤖 Генерирую креативную подпись...")
+            llm_content = await generate_caption_with_llm(job["info"] or {}, job["source"])
+        update_job(job, caption=llm_content)
+    
+    update_job(job, state=JOB_PUBLISHING)
+    return True
+
+async def thumbnail_stage(job: dict) -> bool:
+    """Этап обложки: готовит обложку в памяти (не хранится в базе, дешево пересоздать)"""
+    job["thumbnail"] = None
+    if os.path.exists(job["video_path"]):
+        job["thumbnail"] = await create_thumbnail(job["video_path"], job["info"])
+    return True
+
+async def notify_published(job: dict, published: list, errors: list, post_count: int):
+    """Сообщает отправителю о публикации; с PUBLISH_PREVIEW - превью видео по file_id"""
+    text = f"✅ Опубликовано (пост #{post_count})"
+    if len(CHANNELS) > 1:
+        text += "\n📢 " + ", ".join(channel["name"] for channel, _ in published)
+    if errors:
+        text += "\n⚠️ Не удалось: " + ", ".join(channel["name"] for channel, _ in errors)
+    
+    kind, media = get_sent_media(published[0][1])
+    if PUBLISH_PREVIEW and media is not None and not job.get("batch_id"):
+        try:
+            await get_send_method(kind)(job["chat_id"], **{kind: media.file_id}, caption=text)
+            return
         except Exception as e:
-            print(f"[DEBUG] Queue processor error: {e}")
-            await asyncio.sleep(5)
+            print(f"[DEBUG] Не удалось отправить превью: {e}")
+    await notify_user(job, text)
 
-# ================== RUN ==================
-async def main():
-    # Запускаем обработчик очереди в фоне
-    queue_task = asyncio.create_task(process_video_queue())
+async def publish_stage(job: dict) -> bool:
+    """Этап публикации: отправляет видео (и опрос) во все подходящие каналы"""
+    video_path = job["video_path"]
+    video_id = job["video_id"]
+    normalized_url = job["normalized_url"]
+    llm_content = job["caption"]
+    thumbnail = job.get("thumbnail")
+    
+    # Каналы, куда видео еще не ушло (после перезапуска посреди рассылки - только оставшиеся)
+    channels = [channel for channel in CHANNELS if channel_matches(channel, job)]
+    posted_channels = get_posted_channels(video_id)
+    pending = [channel for channel in channels if channel["chat_id"] not in posted_channels]
     
+    if is_video_posted(video_id) and not pending:
+        update_job(job, state=JOB_DONE)
+        return False
+    
+    if not channels:
+        update_job(job, state=JOB_FAILED, error="no matching channel")
+        await notify_user(job, "⚠️ Нет подходящего канала для этого видео")
+        return False
+    
+    # ---------- Публикация ----------
+    published = []
+    errors = []
+    
+    # Видео уже загружалось в Telegram - отправляем ссылку на file_id вместо файла
+    content_hash = compute_content_hash(video_path) if os.path.exists(video_path) else None
+    cached_media = get_cached_media(video_id, content_hash)
+    file_id = cached_media["file_id"] if cached_media else None
+    media_kind = cached_media["kind"] if cached_media else "video"
+    if file_id:
+        print(f"[DEBUG] Видео из кэша file_id: {video_id}")
+    
+    # Файл загружается один раз: по очереди, пока одна отправка не удастся
+    while pending and file_id is None:
+        channel = pending.pop(0)
+        try:
+            sent_message = await publish_to_channel(channel, job, open_video_input(video_path), thumbnail)
+        except Exception as e:
+            errors.append((channel, e))
+            continue
+        
+        # Отправка удалась - пост уже в канале, какой бы тип медиа ни вернул Telegram
+        published.append((channel, sent_message))
+        save_cached_media(video_id, content_hash, sent_message)
+        media_kind, media = get_sent_media(sent_message)
+        file_id = media.file_id if media is not None else None
+    
+    # Остальные каналы - параллельно, по file_id (у каждого свой лимит)
+    if file_id and pending:
+        results = await asyncio.gather(
+            *(publish_to_channel(channel, job, file_id, kind=media_kind) for channel in pending),
+            return_exceptions=True,
+        )
+        for channel, result in zip(pending, results):
+            if isinstance(result, Exception):
+                errors.append((channel, result))
+            else:
+                published.append((channel, result))
+    
+    for channel, e in errors:
+        print(f"[DEBUG] Publication error ({channel['name']}): {e}")
+    
+    if not published:
+        error_text = "; ".join(f"{channel['name']}: {e}" for channel, e in errors)
+        update_job(job, state=JOB_FAILED, error=error_text[:1000])
+        await notify_user(job, f"❌ Ошибка при отправке в канал: {error_text}")
+        return False
+    
+    # ---------- Сохранение данных ----------
+    first_post = not is_video_posted(video_id)
+    add_video_to_posted(video_id)
+    add_link_to_posted(normalized_url)
+    post_count = increment_post_count() if first_post else get_post_count()
+    
+    # ---------- Создание опроса (каждый 5-й пост) ----------
+    if first_post and should_create_poll():
+        await asyncio.gather(*(send_poll_to_channel(channel, llm_content, message) for channel, message in published))
+    
+    update_job(job, state=JOB_DONE, error="; ".join(f"{channel['name']}: {e}" for channel, e in errors)[:1000] or None)
+    await notify_published(job, published, errors, post_count)
+    return True
+
+async def stage_worker(name: str, in_queue: asyncio.Queue, stage, out_queue=None):
+    """Берет задачи из in_queue, выполняет этап и передает успешные задачи в out_queue"""
     while True:
+        job = await in_queue.get()
         try:
-            await dp.start_polling(bot)
+            passed = await stage(job)
+            if job.get("removed"):
+                # Задачу убрали из расписания, пока этап выполнялся - дальше она не идет
+                update_job(job, state=JOB_FAILED, error="removed from schedule")
+                passed = False
+            if passed and out_queue is not None:
+                # Ограниченная очередь: если следующий этап не успевает, этот ждет
+                await out_queue.put(job)
         except Exception as e:
-            print(f"[DEBUG] Telegram error: {e}")
-            await asyncio.sleep(5)
+            print(f"[DEBUG] Stage {name} error (job {job['id']}): {e}")
+            update_job(job, state=JOB_FAILED, error=str(e)[:1000])
+        finally:
+            # Папка задачи удаляется, как только задача завершена (успех, ошибка, дубликат)
+            admission.release(job)
+            if job["state"] in JOB_FINAL_STATES:
+                cancel_speculative_caption(job)
+                cleanup_job_workspace(job["workdir"])
+                admission.notify()
+                if job.get("prefetching"):
+                    # Повторная загрузка не удалась - окно prefetch заполняется следующей задачей
+                    prefetcher.wake()
+                if job.get("batch_id"):
+                    await update_batch_progress(job["batch_id"])
+            in_queue.task_done()
+
+def start_pipeline() -> list:
+    """Запускает воркеры всех этапов"""
+    workers = []
+    for _ in range(DOWNLOAD_STAGE_WORKERS):
+        workers.append(stage_worker("download", download_queue, download_stage, caption_queue))
+    for _ in range(CAPTION_WORKERS):
+        workers.append(stage_worker("caption", caption_queue, caption_stage, thumbnail_queue))
+    for _ in range(THUMBNAIL_WORKERS):
+        # Готовые задачи идут через планировщик: сразу или в ближайший слот
+        workers.append(stage_worker("thumbnail", thumbnail_queue, thumbnail_stage, publish_scheduler))
+    workers.append(stage_worker("publish", publish_queue, publish_stage))
+    workers.append(publish_scheduler.run())
+    workers.append(prefetcher.run())
+    workers.extend(transcode_pool.start())
+    return [asyncio.create_task(worker) for worker in workers]
+
+async def resume_jobs():
+    """Продолжает незавершенные задачи после перезапуска с последнего завершенного этапа"""
+    jobs = get_unfinished_jobs()
+    for job in jobs:
+        downloaded = job["video_path"] and os.path.exists(job["video_path"])
+        if job["state"] == JOB_CAPTIONING and downloaded:
+            await caption_queue.put(job)
+        elif job["state"] in (JOB_PUBLISHING, JOB_SCHEDULED) and downloaded:
+            # Подпись уже готова, нужна только обложка (затем задача вернется в бэклог)
+            await thumbnail_queue.put(job)
+        elif job["state"] == JOB_SCHEDULED and job["caption"]:
+            # Файлы были вытеснены - задача ждет в бэклоге, пока ее не скачает prefetcher
+            publish_scheduler.restore(job)
+        else:
+            # Загрузка не была завершена - начинаем ее заново
+            download_queue.put_nowait(job)
+    
+    if jobs:
+        print(f"[DEBUG] Восстановлено задач после перезапуска: {len(jobs)}")
+
+# ================== RUN ==================
+async def main():
+    # Удаляем файлы задач, оставшиеся после предыдущего запуска (кроме незавершенных задач)
+    sweep_job_workspaces(keep={job["workdir"] for job in get_unfinished_jobs()})
+    
+    # Запускаем воркеры этапов в фоне и возвращаем в конвейер незавершенные задачи
+    pipeline_tasks = start_pipeline()
+    resume_task = asyncio.create_task(resume_jobs())
+    
+    try:
+        while True:
+            try:
+                await dp.start_polling(bot)
+            except Exception as e:
+                print(f"[DEBUG] Telegram error: {e}")
+                await asyncio.sleep(5)
+    finally:
+        await http_client.close()
 
-asyncio.run(main())
+# Воркеры DOWNLOAD_EXECUTOR=process (spawn/forkserver) импортируют модуль заново - без запуска бота
+if __name__ == "__main__":
+    asyncio.run(main())